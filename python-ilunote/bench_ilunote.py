@@ -0,0 +1,532 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ilunote - benchmarks
+#
+# Copyright (C) 2013 github.com/dayf/ilunote
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# run `python bench_ilunote.py` for all benchmarks on a 10 MB outline,
+# `python bench_ilunote.py --size 100 --output run.json load find` for some,
+# `python bench_ilunote.py --help` for the outline generator options.
+# Every benchmark runs in its own process, so its peak memory is its own.
+# Needs no display; results are JSON to compare runs.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import resource
+import tempfile
+import argparse
+import multiprocessing
+import subprocess
+
+import ilunote
+
+LINE = "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod.\n"
+STYLES = ['hash', 'setext', 'html'] # heading forms understood by ilunote
+BENCHMARKS = ['parse', 'load', 'load_mapped', 'start_cold', 'start_warm', 'as_markdown', 'save_needed', 'save', 'save_edit', 'save_split', 'db_load', 'db_save_edit', 'merge',
+    'store_html', 'store_html_edit', 'site', 'workspace', 'find', 'undo', 'typing', 'line_edit', 'highlight', 'startup']
+QUERIES = ['lorem', 'heading 7', 'not in the notes'] # many, some and no matches
+LOADED = [] # Persistence of each load in this process, see child
+
+
+def make_notes(filename, size, depth=3, breadth=8, body=20, styles=STYLES, seed=1):
+    '''write a notes file of about size bytes; return (bytes, number of headings)
+
+    headings nest up to depth levels with at most breadth children each,
+    bodies have 0..2*body lines, heading styles take turns'''
+    rng = random.Random(seed)
+    counts = [0] * (depth + 1) # children of the current node per level
+    level = 0
+    written = 0
+    n = 0
+    with open(filename, 'wb') as fh:
+        while written < size:
+            n += 1
+            level = min(level + 1, depth)
+            while level > 1 and counts[level] >= breadth: # branch full, go up
+                level -= 1
+            counts[level] += 1
+            for deeper in range(level + 1, depth + 1):
+                counts[deeper] = 0
+            style = styles[n % len(styles)]
+            if style == 'setext' and level <= 2:
+                head = "\nSetext %i\n%s\n" % (n, '=-'[level - 1] * 9)
+            elif style == 'html':
+                head = "<h%i>Html %i</h%i>\n" % (level, n, level)
+            else:
+                head = "\n%s Heading %i\n" % ('#' * level, n)
+            chunk = head + LINE * rng.randint(0, 2 * body)
+            fh.write(chunk)
+            written += len(chunk)
+    return written, n
+
+
+def max_rss():
+    '''peak resident memory of this process in KB (Linux)'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def anon_rss():
+    '''resident memory of this process not backed by files in KB (Linux), None if unknown'''
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('RssAnon:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+class Probe(object): # time and peak memory growth of with blocks
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.rss_kb = 0
+
+    def __enter__(self):
+        self.rss = max_rss()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds += time.time() - self.start
+        self.rss_kb = max(self.rss_kb, max_rss() - self.rss)
+
+
+def load(filename):
+    persistence = ilunote.Persistence()
+    outline = persistence.load(ilunote.Outline(), filename)
+    LOADED.append(persistence)
+    return persistence, outline
+
+
+def edit_middle(outline):
+    node_id = outline.root.children[len(outline.root.children) // 2].id
+    outline.set_desc(node_id, outline.nodes[node_id].desc + 'edited\n')
+
+
+def bench_parse(probe, filename, options):
+    count = 0
+    with probe:
+        for section in ilunote.iter_sections(ilunote.read_lines(filename)):
+            count += 1
+    return {'sections': count}
+
+
+def bench_load(probe, filename, options): # bodies read into memory
+    ilunote.LAZY_LOAD_SIZE = sys.maxint
+    with probe:
+        persistence, outline = load(filename)
+    return {'nodes': len(outline.nodes)}
+
+
+def bench_load_mapped(probe, filename, options): # bodies stay in the file
+    ilunote.LAZY_LOAD_SIZE = 0
+    with probe:
+        persistence, outline = load(filename)
+    return {'nodes': len(outline.nodes)}
+
+
+def bench_start_cold(probe, filename, options): # no snapshot, the notes are parsed
+    with probe:
+        persistence, outline = load(filename)
+    start = time.time()
+    persistence.wait_snapshot()
+    return {'nodes': len(outline.nodes), 'snapshot_seconds': time.time() - start,
+        'snapshot_bytes': os.path.getsize(ilunote.snapshot_name())}
+
+
+def bench_start_warm(probe, filename, options): # loaded from the snapshot of a former start
+    persistence, outline = load(filename)
+    persistence.wait_snapshot()
+    with probe:
+        persistence, outline = load(filename)
+    return {'nodes': len(outline.nodes), 'from_snapshot': persistence.snapshot_thread is None}
+
+
+def bench_as_markdown(probe, filename, options):
+    persistence, outline = load(filename)
+    with probe:
+        text = persistence.as_markdown()
+    return {'bytes': len(text)}
+
+
+def bench_save_needed(probe, filename, options):
+    persistence, outline = load(filename)
+    outline.observers.append(persistence.on_outline_changed)
+    edit_middle(outline)
+    with probe:
+        needed = persistence.save_needed(outline)
+    return {'needed': needed}
+
+
+def bench_save(probe, filename, options): # full rewrite
+    persistence, outline = load(filename)
+    ilunote.INCREMENTAL_SAVE = False
+    with probe:
+        persistence.save(outline, backup=False)
+    return persistence.save_report
+
+
+def bench_save_edit(probe, filename, options): # incremental, after one edit
+    persistence, outline = load(filename)
+    persistence.save(outline, backup=False) # write the index
+    edit_middle(outline)
+    with probe:
+        persistence.save(outline, backup=False)
+    return persistence.save_report
+
+
+def bench_save_split(probe, filename, options): # Ctrl+S after typing a heading into a node, compare with load
+    persistence, outline = load(filename)
+    outline.observers.append(persistence.on_outline_changed)
+    persistence.save(outline, backup=False) # write the index
+    persistence.resection(outline)
+    node_id = outline.root.children[len(outline.root.children) // 2].id
+    outline.set_desc(node_id, outline.nodes[node_id].desc + '\n## typed heading\ntyped\n')
+    with probe:
+        persistence.save(outline, backup=False)
+        ids, changed = persistence.resection(outline)
+    report = dict(persistence.save_report)
+    report['resection'] = persistence.resection_report
+    return report
+
+
+def bench_merge(probe, filename, options): # another program changed one section, compare with load
+    persistence, outline = load(filename)
+    persistence.wait_snapshot()
+    with open(filename, 'rb') as fh:
+        text = fh.read()
+    middle = text.index('\n#', len(text) // 2)
+    with open(filename + '.new', 'wb') as fh: # renamed over it like a save, a mapped file written over is loaded again
+        fh.write(text[:middle] + '\nwritten elsewhere\n' + text[middle:])
+    os.rename(filename + '.new', filename)
+    with probe:
+        ids, changed = persistence.merge(outline)
+    return persistence.merge_report
+
+
+def convert(filename): # the notes as sqlite database
+    persistence, outline = load(filename)
+    database = os.path.splitext(filename)[0] + '.db'
+    ilunote.Database(database).save(outline)
+    persistence.wait_snapshot() # not cut off by the end of the benchmark
+    return database
+
+
+def bench_db_load(probe, filename, options): # compare with load
+    database = convert(filename)
+    with probe:
+        persistence, outline = load(database)
+    return {'nodes': len(outline.nodes), 'bytes': os.path.getsize(database)}
+
+
+def bench_db_save_edit(probe, filename, options): # compare with save_edit
+    persistence, outline = load(convert(filename))
+    outline.observers.append(persistence.on_outline_changed)
+    edit_middle(outline)
+    with probe:
+        persistence.save(outline, backup=False)
+    return persistence.save_report
+
+
+def bench_store_html(probe, filename, options):
+    persistence, outline = load(filename)
+    with probe:
+        success, name = persistence.store_html(outline, filename + '.html')
+    result = {'bytes': os.path.getsize(name) if success else None}
+    result.update(persistence.export_report)
+    return result
+
+
+def bench_store_html_edit(probe, filename, options): # export again after one edit
+    persistence, outline = load(filename)
+    persistence.store_html(outline, filename + '.html') # fill the html cache
+    edit_middle(outline)
+    with probe:
+        success, name = persistence.store_html(outline, filename + '.html')
+    return persistence.export_report
+
+
+def bench_site(probe, filename, options): # page per node, pages/s by number of processes
+    persistence, outline = load(filename)
+    result = {}
+    cores = multiprocessing.cpu_count()
+    counts = sorted(set([n for n in (1, 2, 4, 8, 16) if n < cores] + [cores]))
+    for processes in counts:
+        folder = tempfile.mkdtemp(dir=os.path.dirname(filename))
+        with probe:
+            persistence.store_site(outline, folder, processes)
+        result[str(processes)] = persistence.export_report
+    with probe: # nothing changed, nothing written
+        persistence.store_site(outline, folder, cores)
+    result['unchanged'] = persistence.export_report
+    edit_middle(outline)
+    with probe:
+        persistence.store_site(outline, folder, cores)
+    result['edit'] = persistence.export_report
+    return result
+
+
+def bench_workspace(probe, filename, options): # the notes split into files, loaded by number of processes
+    persistence, outline = load(filename)
+    folder = tempfile.mkdtemp(dir=os.path.dirname(filename))
+    count = options['workspace_files']
+    tops = outline.root.children
+    for number in range(count):
+        with open(os.path.join(folder, 'notes%03i.text' % number), 'wb') as fh:
+            for top in tops[number::count]:
+                fh.write(ilunote.section_markdown(top.title, top.desc, 1))
+                for node, level in outline.walk(top):
+                    fh.write(ilunote.section_markdown(node.title, node.desc, level + 1))
+    result = {}
+    cores = multiprocessing.cpu_count()
+    for processes in sorted(set([n for n in (1, 2, 4, 8, 16) if n < cores] + [cores])):
+        workspace = ilunote.Workspace(folder)
+        with probe:
+            workspace.load(ilunote.Outline(), processes)
+        result[str(processes)] = workspace.load_report
+    persistence, outline = load(folder)
+    outline.observers.append(persistence.on_outline_changed)
+    files = [top for top in outline.root.children if top.children] or outline.root.children # few notes leave files empty
+    top = files[len(files) // 2]
+    node = top.children[0] if top.children else top # else the text before the first heading
+    outline.set_desc(node.id, node.desc + 'edited\n')
+    with probe: # one file written
+        persistence.save(outline, backup=False)
+    result['save_edit'] = persistence.save_report
+    return result
+
+
+def bench_find(probe, filename, options):
+    persistence, outline = load(filename)
+    finder = ilunote.Finder()
+    with probe:
+        finder.search_index.build(outline)
+    result = {'index_seconds': probe.seconds}
+    label = Label()
+    for query in QUERIES:
+        start = time.time()
+        with probe:
+            finder.reset()
+            finder.find(query, outline)
+        result[query] = {'seconds': time.time() - start, 'found': len(finder)}
+        start = time.time()
+        with probe: # jump to the first, as Return in the find entry
+            finder.reset()
+            finder.start(query, outline)
+            finder.get_next(label)
+        result[query]['first_seconds'] = time.time() - start
+    return result
+
+
+class Label(object): # stands in for the find count label
+    def set_text(self, text):
+        self.text = text
+
+
+def bench_undo(probe, filename, options): # sustained typing at the end of a big node
+    outline = ilunote.Outline()
+    node_id = outline.add(None, 'node', LINE * (options['undo_node'] * 1024 // len(LINE)))
+    undo = ilunote.Undo()
+    undo.select(node_id, outline.nodes)
+    offset = len(outline.nodes[node_id].desc)
+    peak = 0
+    with probe:
+        for i in xrange(options['undo_chars']):
+            text = ' ' if i % 6 == 5 else 'a'
+            undo.begin_action() # as done by GtkTextView for each keystroke
+            undo.insert(offset + i, text, offset + i)
+            undo.end_action()
+            peak = max(peak, undo.used)
+    return {'chars': options['undo_chars'], 'steps': len(undo.history[1]), 'peak_bytes': peak,
+        'budget': undo.budget, 'within_budget': peak <= undo.budget}
+
+
+def bench_typing(probe, filename, options): # model work per keystroke in a big node, see Gui.flush_text
+    persistence, outline = load(filename)
+    finder = ilunote.Finder()
+    outline.observers += [persistence.on_outline_changed, finder.search_index.on_outline_changed]
+    finder.search_index.build(outline)
+    node_id = outline.add(None, 'typing', LINE * (options['undo_node'] * 1024 // len(LINE)))
+    head = outline.nodes[node_id].desc
+    result = {}
+    for mode, burst in (('every_key', 1), ('debounced', options['typing_burst'])):
+        typed = []
+        deltas = []
+        worst = 0.0
+        with probe:
+            start = time.time()
+            for i in xrange(options['typing_keys']):
+                key = time.time()
+                deltas.append(('insert_text', {'offset': len(head) + i, 'text': 'a'}))
+                typed.append('a')
+                if len(deltas) == burst: # the timeout of a typing pause
+                    outline.set_desc(node_id, head + ''.join(typed), deltas) # text as one get_text gives it
+                    deltas = []
+                worst = max(worst, time.time() - key)
+            seconds = time.time() - start
+        result[mode] = {'keys': options['typing_keys'], 'mean_ms': 1000 * seconds / options['typing_keys'],
+            'worst_ms': 1000 * worst, 'commits': options['typing_keys'] // burst}
+    return result
+
+
+def bench_line_edit(probe, filename, options): # indent a selection, in one pass and one edit per line
+    text = (LINE * options['edit_lines'])[:-1] # selected lines, the last one without line end
+    result = {'lines': options['edit_lines']}
+    with probe:
+        start = time.time()
+        indented = ilunote.indent_lines(text)
+        result['indent_seconds'] = time.time() - start
+        start = time.time()
+        assert ilunote.unindent_lines(indented) == text
+        result['unindent_seconds'] = time.time() - start
+    per_line = text
+    start = time.time()
+    position = 0
+    for i in xrange(options['edit_lines']): # a tab per line, each a change of the whole text
+        per_line = per_line[:position] + '\t' + per_line[position:]
+        position = per_line.find('\n', position) + 1
+    result['per_line_seconds'] = time.time() - start
+    assert per_line == indented
+    start = time.time()
+    before = '\t\t' + ilunote.BULLET + 'item\n'
+    for i in xrange(options['edit_lines']):
+        ilunote.auto_indent(before, 'Return')
+    result['auto_indent_us'] = 1e6 * (time.time() - start) / options['edit_lines']
+    return result
+
+
+def bench_highlight(probe, filename, options): # found strings in a big node, see Gui.highlight_find
+    text = LINE * (options['undo_node'] * 1024 // len(LINE))
+    result = {}
+    for query in ('lorem', 'elit, sed', 'not in the notes'):
+        start = time.time()
+        with probe:
+            spans = ilunote.find_spans(text, query, ilunote.HIGHLIGHT_MAX)
+        result[query] = {'seconds': time.time() - start, 'spans': len(spans)}
+    return result
+
+
+def startup_seconds(argv, runs=5):
+    '''best wall time of running python with argv, None if it fails'''
+    best = None
+    for i in range(runs):
+        start = time.time()
+        if subprocess.call([sys.executable] + argv, stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT):
+            return None
+        best = min(best, time.time() - start) if best is not None else time.time() - start
+    return best
+
+
+def bench_startup(probe, filename, options): # commands against the imports of the gui
+    script = os.path.splitext(ilunote.__file__)[0] + '.py'
+    gui = 'import sys; sys.path.insert(0, %r); import ilunote, markdown, webbrowser; ilunote.import_gtk()' % (
+        os.path.dirname(script))
+    with probe:
+        result = {'stats': startup_seconds([script, '--file', filename, 'stats']),
+            'search': startup_seconds([script, '--file', filename, 'search', QUERIES[1]])}
+    result['gui_imports'] = startup_seconds(['-c', gui]) # None without Gtk
+    return result
+
+
+def child(name, filename, options):
+    '''run one benchmark on a private copy of filename, print its result as JSON'''
+    folder = os.path.dirname(filename)
+    copy = os.path.join(folder, name + '.text')
+    shutil.copy(filename, copy)
+    ilunote.FOLDER = folder # keep the settings of the user untouched
+    ilunote.JSETFP = os.path.join(folder, name + '.json')
+    probe = Probe()
+    result = globals()['bench_' + name](probe, copy, options)
+    result.update({'seconds': probe.seconds, 'rss_growth_kb': probe.rss_kb, 'peak_rss_kb': max_rss(),
+        'anon_rss_kb': anon_rss()}) # peak_rss_kb counts touched pages of mapped files too
+    for persistence in LOADED: # snapshot threads would be cut off by the exit
+        persistence.wait_snapshot()
+    print json.dumps(result)
+
+
+def run(name, filename, options):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+        '--child', name, filename, json.dumps(options)])
+    return json.loads(output.splitlines()[-1])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='ilunote benchmarks, results as JSON')
+    parser.add_argument('benchmarks', nargs='*', help='some of %s (default all)' % ' '.join(BENCHMARKS))
+    parser.add_argument('--size', type=float, default=10, help='MB of notes (10)')
+    parser.add_argument('--depth', type=int, default=3, help='heading levels (3)')
+    parser.add_argument('--breadth', type=int, default=8, help='children per node (8)')
+    parser.add_argument('--body', type=int, default=20, help='average body lines (20)')
+    parser.add_argument('--styles', default=','.join(STYLES), help='heading styles (%(default)s)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=1, help='runs per benchmark (1)')
+    parser.add_argument('--undo-node', type=int, default=1024, help='KB of the node typed into (1024)')
+    parser.add_argument('--undo-chars', type=int, default=100000, help='chars typed (100000)')
+    parser.add_argument('--typing-keys', type=int, default=1000, help='keys typed into the node (1000)')
+    parser.add_argument('--edit-lines', type=int, default=20000, help='lines indented at once (20000)')
+    parser.add_argument('--workspace-files', type=int, default=32, help='files the notes are split into (32)')
+    parser.add_argument('--typing-burst', type=int, default=3, help='keys typed between pauses (3)')
+    parser.add_argument('--output', help='JSON file, default stdout')
+    parser.add_argument('--child', nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        name, filename, options = args.child
+        child(name, filename, json.loads(options))
+        return 0
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark %s' % name)
+    styles = args.styles.split(',')
+    for style in styles:
+        if style not in STYLES:
+            parser.error('unknown heading style %s' % style)
+
+    generator = {'size': int(args.size * 1024 * 1024), 'depth': args.depth, 'breadth': args.breadth,
+        'body': args.body, 'styles': styles, 'seed': args.seed}
+    options = {'undo_node': args.undo_node, 'undo_chars': args.undo_chars, 'typing_keys': args.typing_keys,
+        'typing_burst': args.typing_burst, 'edit_lines': args.edit_lines, 'workspace_files': args.workspace_files}
+    folder = tempfile.mkdtemp(prefix='ilunote-bench-')
+    filename = os.path.join(folder, 'bench.text')
+    failed = False
+    try:
+        size, headings = make_notes(filename, **generator)
+        report = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+            'platform': platform.platform(), 'version': ilunote.VERSION, 'generator': generator,
+            'file': {'bytes': size, 'headings': headings}, 'options': options, 'results': {}}
+        for name in args.benchmarks or BENCHMARKS:
+            runs = [run(name, filename, options) for i in range(args.repeat)]
+            report['results'][name] = runs
+            best = min(runs, key=lambda r: r['seconds'])
+            sys.stderr.write('%-12s %9.3f s %10i KB\n' % (name, best['seconds'], best['rss_growth_kb']))
+            failed = failed or any(r.get('within_budget') is False for r in runs)
+    finally:
+        shutil.rmtree(folder)
+
+    text = json.dumps(report, indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(text + '\n')
+    else:
+        print text
+    if failed:
+        sys.stderr.write('FAILED: undo budget exceeded\n')
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -23,17 +23,24 @@
 
 __version__ = "2012-04-24"
 
-from gi.repository import Gtk, Gdk # Gtk3, Gdk3
 import os
+import sys
+import errno
 import shutil
 import re
 import time
 import codecs
-import markdown
-import webbrowser
 import json
 import traceback
-
+import hashlib
+import bisect
+import mmap
+import collections
+import marshal
+import threading
+import itertools
+
+Gtk = Gdk = GLib = None # imported by the Gui only, commands run without a display, see import_gtk
 PROGRAM_NAME = 'ilunote'
 FOLDER = os.path.expanduser("~/") + ".local/share/ilunote"
 # FOLDER = os.path.expanduser("~/") + "Dropbox" # "Ubuntu One"
@@ -49,22 +56,85 @@ SEPB = ' > ' # breadcrumb separator
 BULLET = '* '
 DATEFORMAT = "%Y-%m-%d"
 
+# heading forms recognized by Persistence.load, compiled once
+RE_HASH_HEADING = re.compile(r'^(?P<hdr>#+) (?P<title>.*)#*$') # ## title
+RE_HTML_HEADING = re.compile(r'<h(?P<hlev>\d).*?>(?P<title>.*)</h.>') # <h2 a=''>..</h2>
+RE_SETEXT_H1 = re.compile(r'^={3,}') # ==== below title
+RE_SETEXT_H2 = re.compile(r'^-{3,}') # ---- below title
+# line breaks other than \n (and \r\n) that a unicode splitlines() honours
+RE_ODD_EOL = re.compile(r'\r(?!\n)|[\x0b\x0c\x1c\x1d\x1e]|\xc2\x85|\xe2\x80[\xa8\xa9]')
+HEAD_CHARS = '#=-' # first chars of a line that may be a heading
+UTF8_BLOCK = 1 << 20 # validate utf-8 in blocks of this size
+INCREMENTAL_SAVE = True # keep unchanged leading sections of the file, see Persistence.save
+INDEX_SUFFIX = '.index' # sidecar with byte offsets and hashes of the saved sections
+COPY_BLOCK = 1 << 20 # copy unchanged file bytes in blocks of this size
+JOURNAL_SUFFIX = '.journal' # append-only log of unsaved edits, see Journal
+JOURNAL_COMPACT_SIZE = 1 << 20 # fold journal into the notes file above this size ..
+JOURNAL_COMPACT_SECONDS = 30 # .. checked this often
+EXTERNAL_CHECK_SECONDS = 2 # notes file checked this often for writes of other programs, see Gui.on_external_check
+UNDO_BUDGET = 8 << 20 # bytes of undo/redo text kept for all nodes together
+UNDO_DELTA_SIZE = 64 # bytes counted per delta besides its text
+SEARCH_BLOCK = 256 # tree rows per text block of the SearchIndex
+FIND_SLICE = 0.02 # seconds of searching per idle call while typing in find
+TEXT_SYNC_MS = 300 # pause in typing before the text goes into the outline, see Gui.flush_text
+STATUS_MS = 1500 # status messages like ' saved. ' shown this long
+HIGHLIGHT_MAX = 10000 # found strings highlighted in the text at most
+HIGHLIGHT_SLICE = 500 # found strings highlighted per idle call, after the visible ones
+LAZY_LOAD_SIZE = 32 << 20 # files this big stay mapped, bodies are read when used
+BODY_CACHE_SIZE = 16 << 20 # bytes of recently read bodies kept, see MappedFile
+SCAN_BLOCK = 1 << 20 # a mapped file is searched in str copies of this size, bodies lowered for Find too
+PLACEHOLDER = -1 # node id of the row standing in for children not shown yet
+HTML_CACHE_SUFFIX = '.htmlcache' # sidecar with the html of exported sections
+HTML_CACHE_SIZE = 16 << 20 # bytes of html kept in it, least recently exported dropped
+SITE_MANIFEST = '.ilunote-site.json' # pages of a site export with their content hashes
+SITE_CHUNK = 32 # pages handed to an export process at once
+SNAPSHOT_SUFFIX = '.snapshot' # parsed sections of the last notes file, beside the settings (JSETFP)
+SNAPSHOT_VERSION = 1 # format of the snapshot, see write_snapshot
+WORKSPACE_SUFFIXES = ('.text', '.md', '.markdown', '.txt') # notes files of a workspace folder, see Workspace
+WORKSPACE_SUFFIX = '.text' # of the file of a new top level node in a workspace
+DATABASE_SUFFIXES = ('.db', '.sqlite', '.sqlite3') # notes kept in sqlite instead of markdown, see Database
+DATABASE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS nodes (id INTEGER PRIMARY KEY, parent INTEGER, position INTEGER, title TEXT, body TEXT);
+CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (parent, position);
+'''
+
 # http://python-gtk-3-tutorial.readthedocs.org/en/latest/textview.html
 # http://python-gtk-3-tutorial.readthedocs.org/en/latest/unicode.html#python-2
 
 # In general it is recommended to not use unicode objects in GTK+ applications at all and only use UTF-8 encoded str objects since GTK+ does not fully integrate with unicode objects.
 
+def import_gtk():
+    global Gtk, Gdk, GLib
+    from gi.repository import Gtk, Gdk, GLib # Gtk3, Gdk3
+
+
 class Gui:
 
     def __init__(self):
+        import_gtk()
         self.persistence = Persistence()
         self.finder = Finder()
         self.undo = Undo()
+        self.outline = Outline() # the notes, treestore only shows them
+        self.outline.observers.append(self.persistence.on_outline_changed)
+        self.outline.observers.append(self.finder.search_index.on_outline_changed)
         self.keyname = None # name of the key pressed in textview
-        self.indent_pending = False # bullet insertion ongoing flag
+        self.indent_pending = False # auto indent editing, see replace_text
         self.editable_widget = None # for interupted treeitem naming (widget)
         self.editable_path = None   # for interupted treeitem naming (path)
-        self.lastiter = None # keep last iter if current text has lost iter
+        self.text_node = None # id of the node shown in textbuffer
+        self.text_deltas = [] # text edits not yet in the outline, see on_textbuffer_changed
+        self.textbuffer_loading = False # textbuffer set from the outline, not edited
+        self.text_sync = None # GLib source putting the edited text into the outline
+        self.highlight_spans = [] # found strings still to highlight, see highlight_find
+        self.highlight_source = None # GLib source highlighting them
+        self.dragging = False # treeview drag'n'drop ongoing
+        self.drag_row = None # row reference of the dropped copy while dragging
+        self.drag_parent = None # row reference of a parent to refill after the drop
+        self.find_source = None # idle source of the search while typing
+        self.external_stamp = None # file_stamp of the notes as another program wrote them, see on_external_check
+        self.external_asked = False # user kept the own edits over that version
+        self.status_source = None # GLib source clearing label_status
 
         # widgets
         self.window = Gtk.Window()
@@ -76,7 +146,7 @@ class Gui:
         self.scrolled_left = Gtk.ScrolledWindow()
         self.scrolled_left.set_shadow_type(Gtk.ShadowType.IN)
 
-        self.treestore = Gtk.TreeStore(str, object)
+        self.treestore = Gtk.TreeStore(str, int) # title, node id
         self.treeview = Gtk.TreeView(self.treestore)
         self.treeview.set_reorderable(True)
         self.treeview.set_headers_visible(False)
@@ -86,7 +156,7 @@ class Gui:
         self.column = Gtk.TreeViewColumn('Notes', self.renderer, text=0)
         self.treeview.append_column(self.column)
 
-        self.treestore = self.persistence.load(self.treestore)
+        self.load()
 
         x, y = self.persistence.setting['window_size']
         self.window.set_default_size(x, y)
@@ -110,6 +180,7 @@ class Gui:
 
         self.textbuffer = self.textview.get_buffer()
         self.textbuffer.create_tag('highlight', background='yellow')
+        self.undo.attach(self.textbuffer, self.textview)
 
         self.box_bottom = Gtk.HBox()
         self.box_bottom.set_property('margin_right', 3)
@@ -128,9 +199,11 @@ class Gui:
             <menubar name="Menubar">
                 <menu action="File">
                     <menuitem action="Open"/>               
+                    <menuitem action="OpenFolder"/>
                     <menuitem action="Save"/>
                     <separator/>
                     <menuitem action="Html"/>
+                    <menuitem action="Site"/>
                     <separator/>
                     <menuitem action="Exit"/>
                 </menu>
@@ -190,8 +263,10 @@ class Gui:
             ('File', None,'File'),
             ('New', Gtk.STOCK_NEW, 'New', None, 'New file', self.on_open_clicked),
             ('Open', Gtk.STOCK_OPEN, 'Open', '<Control>o','Open file', self.on_open_clicked),
+            ('OpenFolder', Gtk.STOCK_DIRECTORY, 'Open Folder ...', None, 'Open all notes files of a folder', self.on_open_folder_clicked),
             ('Save', Gtk.STOCK_SAVE, 'Save', '<Control>s','Save data to file', self.on_save_clicked),
             ('Html', Gtk.STOCK_PRINT_PREVIEW, 'Export as HTML ...',   None, 'Export as HTML', self.on_export_html_clicked),
+            ('Site', None, 'Export as Web Site ...', None, 'Export one HTML page per node', self.on_export_site_clicked),
             ('Exit', Gtk.STOCK_QUIT, 'Exit', None, 'Close ' + PROGRAM_NAME, self.on_exit_clicked),
             ('Settings', Gtk.STOCK_PROPERTIES, 'Settings', '<Control>p', 'Preferences', self.on_pref_clicked),
             ('Tree', None, 'Tree'),
@@ -259,6 +334,17 @@ class Gui:
         self.entry_find.connect('activate', self.on_find_return)
         self.entry_find.connect('focus-out-event', self.on_find_focus_out)
         self.textbuffer.connect('changed', self.on_textbuffer_changed)
+        self.textbuffer.connect('insert-text', self.on_textbuffer_insert_text)
+        self.textbuffer.connect('delete-range', self.on_textbuffer_delete_range)
+        self.textbuffer.connect('begin-user-action', self.on_textbuffer_begin_user_action)
+        self.textbuffer.connect('end-user-action', self.on_textbuffer_end_user_action)
+        self.treestore.connect('row-changed', self.on_treestore_row_changed) # drag'n'drop
+        self.treestore.connect('row-deleted', self.on_treestore_row_deleted)
+        self.treeview.connect('drag-begin', self.on_treeview_drag_begin)
+        self.treeview.connect('drag-end', self.on_treeview_drag_end)
+        self.treeview.connect('test-expand-row', self.on_treeview_test_expand_row)
+        GLib.timeout_add_seconds(JOURNAL_COMPACT_SECONDS, self.on_journal_compact)
+        GLib.timeout_add_seconds(EXTERNAL_CHECK_SECONDS, self.on_external_check)
 
         # show gui
         self.window.show_all()
@@ -277,42 +363,34 @@ class Gui:
             self.on_find_return(self.entry_find) # issue 'on_find_return' event
 
     def on_treeview_selection_changed(self, selection):
+        self.flush_text() # edits of the node shown so far
         model, iter = selection.get_selected()
         
         title_path = []
 
         if iter is not None:
-
-            # breadcrumb
-            the_iter = iter
-            while True:
-                title = self.treestore[the_iter][0]
-                title_path.append(title)
-                the_iter = self.treestore.iter_parent(the_iter)
-                if the_iter is None:
-                    break
-
-            text = self.treestore.get_value(iter, 1) # encoding?
-            self.textbuffer.set_text(text)
-            self.undo.clear() # clear undo stack when tree item changed
-            self.undo.add(self.textbuffer, self.textview, text) # put entry situation in undo stack
-            self.lastiter = iter
+            node = self.outline.nodes[self.treestore.get_value(iter, 1)]
+            self.set_textbuffer(node.desc)
+            self.undo.select(node.id, self.outline.nodes) # undo history of this node
+            self.text_node = node.id
+            title_path = self.outline.titles(node.id) # breadcrumb
         else:
             print 'iter is none in on_treeview_selection_changed.'
-            if self.treestore.get_value(self.lastiter, 0) == None: # happens after drag'n'drop
+            if self.text_node is not None and self.text_node not in self.outline.nodes: # node deleted
                 self.select_last_path('0') # select first tree entry..
                 # .. because we lost all info where we are in the tree
 
-        title_path.reverse()
         self.window.set_title(PROGRAM_NAME + SEPN + SEPB.join(title_path))
 
 
     def on_cell_edited(self, cell, path, new_text): # Cell in treeview edited and left
         model, iter = self.treeview_selection.get_selected()
         if iter is not None:
+            self.flush_text()
             self.treestore.set_value(iter, 0, new_text) #todo: update breadcrumb
-            text = self.treestore.get_value(iter, 1)
-            self.textbuffer.set_text(text)
+            node_id = self.treestore.get_value(iter, 1)
+            self.outline.set_title(node_id, new_text)
+            self.set_textbuffer(self.outline.nodes[node_id].desc)
         else:
             print 'Error: no iter in on_cell_edited'
 
@@ -327,6 +405,7 @@ class Gui:
         path = self.editable_path
         iter = self.treestore.get_iter_from_string(path)
         self.treestore.set_value(iter, 0, text)
+        self.outline.set_title(self.treestore.get_value(iter, 1), text)
 
 
     def on_treeview_clicked(self, widget, event): # click on treeview item
@@ -341,110 +420,348 @@ class Gui:
 
     def select_last_path(self, str_path): # select first row in treeview
         path = Gtk.TreePath.new_from_string(str_path)
+        self.populate_path(path.get_indices()) # rows may not exist yet
         copy_of_path = path.copy()
         copy_of_path.up() # get parent to avoid expansion of child
         self.treeview.expand_to_path(copy_of_path) # open treeview at last position
         self.treeview.set_cursor(path, self.column, start_editing=False)
 
 
+    def build_view(self): # fill treestore with the top level of the outline
+        self.treeview.set_model(None) # no redraws while filling
+        self.treestore.clear()
+        self.add_rows(None, self.outline.root.children)
+        self.treeview.set_model(self.treestore)
+
+
+    def add_rows(self, parent, nodes): # rows of nodes, their children wait behind a placeholder
+        for node in nodes:
+            row = self.treestore.append(parent, [node.title, node.id])
+            if node.children:
+                self.treestore.append(row, ['', PLACEHOLDER])
+
+
+    def populate(self, iter): # replace the placeholder below iter by the rows of the children
+        child = self.treestore.iter_children(iter)
+        if child is not None and self.treestore.get_value(child, 1) == PLACEHOLDER:
+            self.add_rows(iter, self.outline.nodes[self.treestore.get_value(iter, 1)].children)
+            self.treestore.remove(child)
+
+
+    def unpopulate(self, iter): # drop the rows below iter, back to a placeholder
+        child = self.treestore.iter_children(iter)
+        while child is not None:
+            self.treestore.remove(child)
+            child = self.treestore.iter_children(iter)
+        self.treestore.append(iter, ['', PLACEHOLDER])
+
+
+    def populate_path(self, indices): # add the rows down to the row at indices
+        for depth in range(1, len(indices)):
+            try:
+                iter = self.treestore.get_iter(Gtk.TreePath(indices[:depth]))
+            except ValueError: # no such row
+                return
+            self.populate(iter)
+
+
+    def row_iter(self, node): # iter of the row of node, None if not in the treestore
+        chain = []
+        while node is not self.outline.root:
+            chain.append(node)
+            node = node.parent
+        iter = None
+        for node in reversed(chain):
+            iter = self.treestore.iter_nth_child(iter, self.outline.position(node))
+            if iter is None or self.treestore.get_value(iter, 1) != node.id: # a placeholder, children not shown
+                return None
+        return iter
+
+
+    def update_rows(self, changes): # rows of the children changes affected, see ViewChanges; True if any
+        def depth(node):
+            count = 0
+            while node.parent is not None:
+                node = node.parent
+                count += 1
+            return count
+
+        for parent in sorted(changes.spans, key=depth): # rows of the parents placed first
+            iter = None
+            if parent is not self.outline.root:
+                if self.outline.nodes.get(parent.id) is not parent: # removed
+                    continue
+                iter = self.row_iter(parent)
+                if iter is None:
+                    continue
+                child = self.treestore.iter_children(iter)
+                if child is None or self.treestore.get_value(child, 1) == PLACEHOLDER: # children not shown yet
+                    if child is None and parent.children:
+                        self.treestore.append(iter, ['', PLACEHOLDER])
+                    elif child is not None and not parent.children:
+                        self.treestore.remove(child)
+                    continue
+            head, tail = changes.spans[parent]
+            for count in xrange(self.treestore.iter_n_children(iter) - head - tail):
+                self.treestore.remove(self.treestore.iter_nth_child(iter, head))
+            for position in xrange(head, len(parent.children) - tail):
+                node = parent.children[position]
+                row = self.treestore.insert(iter, position, [node.title, node.id])
+                if node.children:
+                    self.treestore.append(row, ['', PLACEHOLDER])
+        for node in changes.titles:
+            iter = self.row_iter(node) if self.outline.nodes.get(node.id) is node else None
+            if iter is not None:
+                self.treestore.set_value(iter, 0, node.title)
+        return bool(changes.spans)
+
+
+    def view_path(self, node_id): # treestore path of a node, its row added if needed
+        path = self.outline.path(node_id)
+        self.populate_path(path)
+        return Gtk.TreePath(path)
+
+
+    def on_treeview_test_expand_row(self, treeview, iter, path):
+        self.populate(iter)
+        return False # expand
+
+
+    def on_treestore_row_changed(self, treestore, path, iter): # drag'n'drop copies the dragged rows
+        if self.dragging and self.drag_row is None: # the first copy is the dropped node
+            self.drag_row = Gtk.TreeRowReference.new(treestore, path)
+
+
+    def on_treestore_row_deleted(self, treestore, path): # drag'n'drop removes the dragged rows
+        if self.dragging and self.drag_row is not None and self.drag_row.valid():
+            path = self.drag_row.get_path() # the drop, with the source rows gone
+            iter = treestore.get_iter(path)
+            parent = treestore.iter_parent(iter)
+            parent_id = None if parent is None else treestore.get_value(parent, 1)
+            position = 0 # among the nodes, placeholders left out
+            for index in range(treestore.iter_n_children(parent)):
+                if treestore.get_value(treestore.iter_nth_child(parent, index), 1) == PLACEHOLDER:
+                    self.drag_parent = Gtk.TreeRowReference.new(treestore, treestore.get_path(parent))
+                elif index < path.get_indices()[-1]:
+                    position += 1
+            self.outline.move(treestore.get_value(iter, 1), parent_id, position)
+            self.drag_row = None
+
+
+    def on_treeview_drag_begin(self, widget, context):
+        self.dragging = True
+        self.drag_row = None
+        self.drag_parent = None
+
+
+    def on_treeview_drag_end(self, widget, context):
+        self.dragging = False
+        self.drag_row = None
+        if self.drag_parent is not None and self.drag_parent.valid(): # dropped into unshown children
+            self.unpopulate(self.treestore.get_iter(self.drag_parent.get_path()))
+        self.drag_parent = None
+
+
+    def on_journal_compact(self): # fold a grown journal into the notes file
+        self.flush_text()
+        if self.persistence.journal.size() > JOURNAL_COMPACT_SIZE and not self.dragging:
+            self.save_and_reload()
+        return True # keep the timeout
+
+
+    def on_external_check(self): # timeout: notes written by another program, eg a sync of another machine?
+        if not self.persistence.changed_on_disk():
+            self.external_stamp = None
+            return True
+        stamp = file_stamp(self.persistence.setting['filename'])
+        if stamp != self.external_stamp: # wait until the writer is done
+            self.external_stamp = stamp
+            self.external_asked = False
+            return True
+        if self.external_asked or self.dragging:
+            return True
+        self.flush_text()
+        if self.persistence.save_needed(self.outline):
+            self.external_asked = True
+            if not self.show_yesno_dialog("Changed", "%s was changed by another program.\nLoad it and drop your changes?"
+                    % self.persistence.setting['filename']):
+                return True # the next save overwrites it
+        try:
+            self.update_outline(self.persistence.merge)
+        except (IOError, OSError, ValueError, IndexError), e: # eg not utf-8, the journal keeps recording
+            self.external_asked = True # until it is written again
+            self.show_message("Changed", "%s was changed by another program and could not be read:\n%s"
+                % (self.persistence.setting['filename'], e))
+        return True
+
+    def update_outline(self, change): # change(outline) as Persistence.merge, keep selection and expanded rows
+        expanded = [] # node ids
+        self.treeview.map_expanded_rows(lambda treeview, path, data: expanded.append(self.treestore[path][1]), None)
+        node_id = self.text_node
+        cursor = self._cursor_offset()
+        path = self._current_path()
+        view_changes = ViewChanges()
+        self.outline.observers.append(view_changes.on_outline_changed)
+        try:
+            changes = change(self.outline)
+        finally:
+            self.outline.observers.remove(view_changes.on_outline_changed)
+        if changes is None: # a workspace, or the whole file is needed
+            self.load()
+            self.select_last_path(str(path))
+            return
+        ids, changed = changes
+        self.undo.remap(ids, changed)
+        if ids is not None: # rows of the old ids
+            self.text_node = None
+            self.cancel_find_scan()
+            self.finder.reset()
+            self.finder.search_index.invalidate()
+            self.build_view()
+            for expanded_id in expanded:
+                if expanded_id in ids:
+                    self.treeview.expand_to_path(self.view_path(ids[expanded_id]))
+            if node_id not in ids:
+                self.select_last_path('0')
+                return
+            self.treeview.set_cursor(self.view_path(ids[node_id]), self.column, False)
+        else: # same ids, rows of the changed nodes only
+            moved = self.update_rows(view_changes)
+            if moved:
+                if not self.finder.done or any(found not in self.outline.nodes for found in self.finder):
+                    self.cancel_find_scan() # found in removed nodes
+                    self.finder.reset()
+                for expanded_id in expanded:
+                    if expanded_id in self.outline.nodes:
+                        self.treeview.expand_to_path(self.view_path(expanded_id))
+                if node_id in self.outline.nodes: # its row may be new, shown again from the start
+                    self.treeview.set_cursor(self.view_path(node_id), self.column, False)
+            if node_id not in self.outline.nodes:
+                self.select_last_path('0')
+                return
+            self.undo.select(node_id, self.outline.nodes)
+            if node_id in changed:
+                self.set_textbuffer(self.outline.nodes[node_id].desc) # the shown text ends as in the file
+            elif not moved:
+                return
+        cursor = min(cursor, self.textbuffer.get_char_count())
+        self.textbuffer.place_cursor(self.textbuffer.get_iter_at_offset(cursor))
+
+
     # textbuffer
-    def on_textbuffer_changed(self, textbuffer):
-        model, iter = self.treeview_selection.get_selected()
-        if iter is None:
-            print 'Error: no iter in on_textbuffer_changed. Taking lastiter'
-            iter = self.lastiter
+    def set_textbuffer(self, text): # show node text without treating it as an edit
+        self.flush_text() # callers flush before reading the outline
+        self.cancel_highlight() # of the former text
+        self.textbuffer_loading = True
+        try:
+            self.textbuffer.set_text(text)
+        finally:
+            self.textbuffer_loading = False
+
+
+    def _cursor_offset(self):
+        return self.textbuffer.get_iter_at_mark(self.textbuffer.get_insert()).get_offset()
+
+
+    def on_textbuffer_insert_text(self, textbuffer, location, text, length):
+        if not self.textbuffer_loading:
+            self.text_deltas.append(('insert_text', {'offset': location.get_offset(), 'text': text}))
+            self.undo.insert(location.get_offset(), text, self._cursor_offset())
+
+
+    def on_textbuffer_delete_range(self, textbuffer, start, end):
+        if not self.textbuffer_loading:
+            self.text_deltas.append(('delete_text', {'start': start.get_offset(), 'end': end.get_offset()}))
+            self.undo.delete(start.get_offset(), textbuffer.get_text(start, end, True), self._cursor_offset())
+
 
-        start = textbuffer.get_start_iter()
-        end = textbuffer.get_end_iter()
-        text = textbuffer.get_text(start, end, True)
-        self.treestore.set_value(iter, 1, text)
+    def on_textbuffer_begin_user_action(self, textbuffer): # eg a keystroke with its auto indent
+        self.undo.begin_action()
 
-        start, end = textbuffer.get_bounds()
-        text = textbuffer.get_text(start, end, True)
 
-        self.undo.add(textbuffer, self.textview, text)
+    def on_textbuffer_end_user_action(self, textbuffer):
+        self.undo.end_action()
 
-        # auto indent/bullet
-        bullet = BULLET
+
+    def on_textbuffer_changed(self, textbuffer):
+        if self.textbuffer_loading or self.text_node is None: # outline has this text already
+            return
+
+        self.cancel_highlight() # offsets of the text before
+        if self.text_sync is not None: # still typing
+            GLib.source_remove(self.text_sync)
+        self.text_sync = GLib.timeout_add(TEXT_SYNC_MS, self.on_text_sync)
+
+        if self.indent_pending or self.undo.freeze: # changed by the auto indent below, or undo/redo replays it
+            return
         current_iter = textbuffer.get_iter_at_mark(textbuffer.get_insert())
-        line_number = current_iter.get_line()
-        new_line = current_iter.starts_line() # True if CR/LF
-
-        outdent = True # True = go to position zero
-
-        if new_line and self.keyname not in ('BackSpace','Delete') and self.indent_pending == False:
-            last_line_iter = textbuffer.get_iter_at_line(line_number - 1) # get start iter of last line
-            last_line = textbuffer.get_text(last_line_iter, current_iter, True) # get last line text
-            tab_count = 0
-            for char in last_line:
-                if char == '\t': tab_count += 1 # count leading tabs
-                else: break # stop at first non-tab char
-            tabs = '\t' * tab_count # create string of tabs
-            textbuffer.insert_at_cursor(tabs) # insert string of tabs
-            cr_stripped_last_line = last_line.lstrip('\n') # strip leading CR from last line
-            tab_stripped_last_line = cr_stripped_last_line.lstrip('\t') # strip leading tabs from last line
-            if tab_stripped_last_line[:2] == bullet: # does tab stripped last line starts with a bullet?
-                if len(tab_stripped_last_line) > 3: # has last line text on the right side of the bullet
-                    textbuffer.insert_at_cursor(bullet) # insert bullet (after leading tabs)
-                else: # bullet only in last line
-                    last_line_iter = textbuffer.get_iter_at_line(line_number - 1) # get start iter of last line
-                    last_line_iter.backward_char() # step one char back
-                    current_iter = textbuffer.get_iter_at_mark(textbuffer.get_insert()) # get iter of current position
-                    textbuffer.delete(last_line_iter, current_iter) # delete last line
-                    if outdent: tabs = ""
-                    textbuffer.insert_at_cursor('\n' + tabs + '\n' + tabs) # insert two CRs
-            elif len(tab_stripped_last_line) == 1 and outdent: # last line has only a CR
-                self.indent_pending = True # prevent running into the new_line branch
-                last_line_iter = textbuffer.get_iter_at_line(line_number - 1) # get start iter of last line
-                current_iter = textbuffer.get_iter_at_mark(textbuffer.get_insert()) # get iter of current position
-                textbuffer.delete(last_line_iter, current_iter) # delete last line
-                textbuffer.insert_at_cursor('\n') # insert CR
-                self.indent_pending = False # reset prevention flag to default
-        elif self.keyname == 'Tab': # further indentation with Tab after '- '
-            last_iter = current_iter.copy() # get current position
-            current_iter.backward_chars(3) # move three steps back, before the '- \t'
-            last_text = textbuffer.get_text(current_iter, last_iter, True) # MIG get the text
-            if last_text == bullet + '\t': # check if tab was pressed after '- '
-                self.indent_pending = True # prevent running into new_line if-branch when further indented
-                textbuffer.delete(current_iter, last_iter) # delete it
-                textbuffer.insert_at_cursor('\t' + bullet) # do further indentation
-                self.indent_pending = False # reset prevention flag to default
-        elif self.keyname == 'BackSpace' and self.indent_pending == False: # outdent with Backspace after '- '
-            start_line_iter = textbuffer.get_iter_at_line(line_number) # start of current line
-            text_in_line = textbuffer.get_text(start_line_iter, current_iter, True) # MIG get text of current line
-            cr_stripped_line = text_in_line.lstrip('\n') # strip leading CR from line
-            tab_stripped_line = cr_stripped_line.lstrip('\t') # strip leading tabs from line
-            if tab_stripped_line + ' ' == bullet:
-                self.indent_pending = True # prevent running into this branch
-                end_iter = start_line_iter.copy() # copy of line start
-                end_iter.forward_char() # one step forward
-                textbuffer.delete(start_line_iter, end_iter) # delete first tab in line
-                textbuffer.insert_at_cursor(' ') # add missing blank near '-'
-                self.indent_pending = False
+        start_iter = textbuffer.get_iter_at_line(max(current_iter.get_line() - 2, 0))
+        edit = auto_indent(textbuffer.get_text(start_iter, current_iter, True), self.keyname)
+        if edit is not None:
+            count, text = edit
+            start_iter = current_iter.copy()
+            start_iter.backward_chars(count)
+            self.replace_text(start_iter, current_iter, text)
+
+
+    def replace_text(self, start_iter, end_iter, text): # one undo step, no auto indent
+        self.indent_pending = True
+        self.textbuffer.begin_user_action()
+        try:
+            self.textbuffer.delete(start_iter, end_iter) # start_iter stays valid
+            self.textbuffer.insert(start_iter, text)
+        finally:
+            self.textbuffer.end_user_action()
+            self.indent_pending = False
+
+
+    def on_text_sync(self): # timeout: typing paused
+        self.text_sync = None
+        self.flush_text()
+        return False
+
+
+    def flush_text(self): # put edits of the textbuffer into the outline, one get_text for all
+        if self.text_sync is not None:
+            GLib.source_remove(self.text_sync)
+            self.text_sync = None
+        deltas, self.text_deltas = self.text_deltas, []
+        if not deltas or self.text_node not in self.outline.nodes: # no edits, or node deleted
+            return
+        text = self.textbuffer.get_text(self.textbuffer.get_start_iter(), self.textbuffer.get_end_iter(), True)
+        self.outline.set_desc(self.text_node, text, deltas)
 
 
     def on_indent_clicked(self, action): # Indent or Unindent selected text
         widget = self.window.get_focus()
         if isinstance(widget, Gtk.TextView):
+            selected = True
             try:
                 current_iter, end_iter = self.textbuffer.get_selection_bounds()
             except ValueError: # nothing selected
                 current_iter = self.textbuffer.get_iter_at_mark(self.textbuffer.get_insert()) # current position
-                end_iter = current_iter
+                end_iter = current_iter.copy()
+                selected = False
             line_number = current_iter.get_line() # number of first selected line
-            end_line_number = end_iter.get_line() # number of last selected line
-            while line_number <= end_line_number:
-                start_line_iter = self.textbuffer.get_iter_at_line(line_number) # start of current line
-                if action.get_name() == 'Indent':
-                    self.textbuffer.insert(start_line_iter, '\t')
-                else: # Unindent
-                    end_iter = start_line_iter.copy() # copy of line start
-                    end_iter.forward_char()
-                    first_char = self.textbuffer.get_text(start_line_iter, end_iter, True)
-                    if first_char == '\t':
-                        self.textbuffer.delete(start_line_iter, end_iter) # delete first tab in line
-
-                line_number += 1
+            column = current_iter.get_line_offset()
+            start_iter = self.textbuffer.get_iter_at_line(line_number)
+            if not end_iter.ends_line():
+                end_iter.forward_to_line_end() # end of last selected line
+            text = self.textbuffer.get_text(start_iter, end_iter, True)
+            if action.get_name() == 'Indent':
+                new_text = indent_lines(text)
+            else: # Unindent
+                new_text = unindent_lines(text)
+            if new_text == text:
+                return
+            start = start_iter.get_offset()
+            self.replace_text(start_iter, end_iter, new_text) # all lines in one go
+            if selected: # select the lines
+                self.textbuffer.select_range(self.textbuffer.get_iter_at_offset(start),
+                    self.textbuffer.get_iter_at_offset(start + len(new_text.decode('utf-8'))))
+            else: # cursor stays at its text
+                column = max(column + len(new_text) - len(text), 0) # tabs only, bytes are chars
+                self.textbuffer.place_cursor(self.textbuffer.get_iter_at_line_offset(line_number, column))
 
 
     # edit
@@ -454,9 +771,11 @@ class Gui:
             if len(model) == 1 and model.iter_depth(iter) == 0:
                 self.show_message("Delete", "Cannot delete the last item")
             else:
-                title, desc = self.treestore[iter]
+                node_id = self.treestore.get_value(iter, 1)
+                title = self.outline.nodes[node_id].title
                 if self.show_yesno_dialog("Delete", 'Delete the selected node "%s"?' % title):
                     path = self.treestore.get_path(iter)
+                    self.outline.remove(node_id)
                     model.remove(iter)
                     if path.prev(): pass
                     else: path.up()
@@ -485,7 +804,7 @@ class Gui:
             end_iter = self.textbuffer.get_iter_at_line(line_number+1) # end of line
             if start_iter.get_offset() == end_iter.get_offset(): # last line?
                 end_iter = self.textbuffer.get_end_iter()
-            self.textbuffer.delete(start_iter, end_iter)
+            self.replace_text(start_iter, end_iter, '')
 
 
     def on_undo_clicked(self, button): # Undo clicked
@@ -513,37 +832,62 @@ class Gui:
 
     # search
     def on_find_return(self, widget): # RETURN pressed in Find entry
+        self.flush_text() # search the text as typed
         if not self.finder.mode: # start find
             find_text = self.entry_find.get_text()
-            if find_text != '':
-                result = self.finder.find(find_text, self.treestore)
-                if not result:
-                    self.finder.reset() # nothing to find
-                    self.label_find_count.set_text('0/0')
-                    return False
-            else:
+            if find_text == '':
                 return False # nothing to find
+            self.finder.start(find_text, self.outline)
+        self.cancel_find_scan() # searched as far as needed here, the rest when idle
 
-        self.treeview.collapse_all() # collapse tree to avoid mess
-        if self.keyname in ['Page_Down', 'Return']:
-            iter = self.finder.get_next(self.label_find_count) # continue find
         if self.keyname == 'Page_Up':
-            iter = self.finder.get_previous(self.label_find_count)
+            node_id = self.finder.get_previous(self.label_find_count)
+        else: # Page_Down, Return
+            node_id = self.finder.get_next(self.label_find_count) # continue find
+        if node_id is None:
+            self.finder.reset() # nothing to find
+            self.label_find_count.set_text('0/0')
+            return False
+        if not self.finder.done: # count them
+            self.find_source = GLib.idle_add(self.on_find_scan)
 
-        path = self.treestore.get_path(iter)
+        self.treeview.collapse_all() # collapse tree to avoid mess
+        path = self.view_path(node_id)
         self.treeview.expand_to_path(path)
         self.treeview.set_cursor(path, self.column, start_editing=False)
         self.highlight_find(self.entry_find.get_text())
 
 
     def on_find_focus_out(self, widget, event): # leaving find widget
+        self.cancel_find_scan()
         self.finder.reset()
         self.label_find_count.set_text('')
 
 
-    def on_find_changed(self, widget): # find text changed
-        self.finder.reset()
-        self.label_find_count.set_text('')
+    def on_find_changed(self, widget): # find text changed: search while typing
+        self.flush_text()
+        self.cancel_find_scan()
+        find_text = self.entry_find.get_text()
+        if find_text == '':
+            self.finder.reset()
+            self.label_find_count.set_text('')
+            return
+        self.finder.start(find_text, self.outline) # narrows the last search if possible
+        self.find_source = GLib.idle_add(self.on_find_scan)
+
+
+    def on_find_scan(self): # idle: search a slice of the tree
+        done = self.finder.scan(FIND_SLICE)
+        self.label_find_count.set_text(self.finder.count_text())
+        if done:
+            self.find_source = None
+        return not done # keep going until done
+
+
+    def cancel_find_scan(self): # stop a search of an older find text
+        if self.find_source is not None:
+            GLib.source_remove(self.find_source)
+            self.find_source = None
 
 
     def on_find_clicked(self, widget): # Menu Find or Ctrl+F
@@ -551,22 +895,48 @@ class Gui:
 
 
     def highlight_find(self, find_text): # highlight found string in description
-        tag_table = self.textbuffer.get_tag_table()
-        tag_highlight = tag_table.lookup('highlight')
-        searchiter = self.textbuffer.get_iter_at_offset(0) # start in textbuffer
-        while True: # repeat search
-            try:
-                match_start, match_end = \
-                    searchiter.forward_search(find_text, \
-                    Gtk.TextSearchFlags.CASE_INSENSITIVE, \
-                    self.textbuffer.get_end_iter())
-                start_pos = match_start.get_offset() # get found positions ..
-                end_pos = match_end.get_offset() # .. and ..
-                start_iter = self.textbuffer.get_iter_at_offset(start_pos) # .. make them ..
-                end_iter = self.textbuffer.get_iter_at_offset(end_pos) # .. the iters for textbuffer
-                self.textbuffer.apply_tag(tag_highlight, start_iter, end_iter) # highlight search term in textbuffer
-                searchiter = match_end # set new search start position
-            except TypeError: break # stop if all strings found
+        self.cancel_highlight()
+        tag_highlight = self.textbuffer.get_tag_table().lookup('highlight')
+        self.textbuffer.remove_tag(tag_highlight, self.textbuffer.get_start_iter(), self.textbuffer.get_end_iter())
+        if not find_text or self.text_node not in self.outline.nodes:
+            return
+        spans = find_spans(self.outline.nodes[self.text_node].desc, find_text, HIGHLIGHT_MAX)
+        rect = self.textview.get_visible_rect()
+        top = self.textview.get_line_at_y(rect.y)[0]
+        bottom = self.textview.get_line_at_y(rect.y + rect.height)[0]
+        bottom.forward_line()
+        first = bisect.bisect_left(spans, (top.get_offset(), 0))
+        last = bisect.bisect_left(spans, (bottom.get_offset(), 0))
+        self.apply_highlight(spans[first:last]) # visible now, the others when idle
+        self.highlight_spans = spans[last:] + spans[:first] # below first
+        if self.highlight_spans:
+            self.highlight_source = GLib.idle_add(self.on_highlight_idle)
+
+
+    def on_highlight_idle(self): # idle: highlight some more found strings
+        spans = self.highlight_spans
+        self.apply_highlight(spans[:HIGHLIGHT_SLICE])
+        del spans[:HIGHLIGHT_SLICE]
+        if not spans:
+            self.highlight_source = None
+        return bool(spans)
+
+
+    def cancel_highlight(self): # found strings are not highlighted further
+        self.highlight_spans = []
+        if self.highlight_source is not None:
+            GLib.source_remove(self.highlight_source)
+            self.highlight_source = None
+
+
+    def apply_highlight(self, spans): # (start, end) offsets in textbuffer
+        tag_highlight = self.textbuffer.get_tag_table().lookup('highlight')
+        start_iter = self.textbuffer.get_start_iter()
+        end_iter = self.textbuffer.get_start_iter()
+        for start, end in spans:
+            start_iter.set_offset(start)
+            end_iter.set_offset(end)
+            self.textbuffer.apply_tag(tag_highlight, start_iter, end_iter)
 
 
     # insert
@@ -574,7 +944,9 @@ class Gui:
         model, iter = self.treeview_selection.get_selected()
         if iter is not None:
             parent = self.treestore.iter_parent(iter)
-            newiter =self.treestore.append(parent, ["New", ""])
+            parent_id = None if parent is None else self.treestore.get_value(parent, 1)
+            node_id = self.outline.add(parent_id, "New", "")
+            newiter = self.treestore.append(parent, ["New", node_id])
             path = self.treestore.get_path(newiter)
             self.renderer.set_property('editable', True)
             self.treeview.set_cursor(path, self.column, start_editing=True)
@@ -587,7 +959,9 @@ class Gui:
         model, iter = self.treeview_selection.get_selected()
         if iter is not None:
             path = self.treestore.get_path(iter) # get path of current iter
-            newiter = self.treestore.append(iter, ["New", ""]) # create the new entry
+            self.populate(iter) # rows of the other children first
+            node_id = self.outline.add(self.treestore.get_value(iter, 1), "New", "")
+            newiter = self.treestore.append(iter, ["New", node_id]) # create the new entry
             self.treeview.expand_row(path, False) # expand this branch (one level deep)
             path = self.treestore.get_path(newiter) # path of the new entry
             self.renderer.set_property('editable', True)
@@ -611,52 +985,81 @@ class Gui:
 
 
     def on_open_clicked(self, widget):
+        self.open_notes("file")
+
+    def on_open_folder_clicked(self, widget): # a workspace: all notes files of a folder
+        self.open_notes("folder")
+
+    def open_notes(self, action): # ask for a file or folder and load it
+        self.flush_text()
         # like on_exit_clicked:
         self.persistence.save_settings()
-        if self.persistence.save_needed(self.treestore):
-            if self.show_yesno_dialog("Close", "Save changes to %s?" % self.persistence.setting['filename'], default_button_yes=True):
-                self.persistence.save(self.treestore, backup=True)        
+        answer = None
+        if self.persistence.save_needed(self.outline):
+            answer = self.show_yesno_dialog("Close", "Save changes to %s?" % self.persistence.setting['filename'], default_button_yes=True)
+            if answer:
+                self.persistence.save(self.outline, backup=True)        
         homefolder = os.path.expanduser("~/")
-        openfile = self.show_file_chooser("Select file ...", "file", homefolder)
+        openfile = self.show_file_chooser("Select %s ..." % action, action, homefolder)
         if openfile is not False:       
-            self.treestore = self.persistence.load(self.treestore, openfile)
+            if answer is False:
+                self.persistence.journal.discard() # changes dismissed
+            self.load(openfile)
             path = self.persistence.setting['last_path'] # todo: sense?
             self.select_last_path(path)
 
     def on_exit_clicked(self, widget):
+        self.flush_text()
         self.update_settings()
         self.persistence.save_settings()
-        if self.persistence.save_needed(self.treestore):
-            if self.show_yesno_dialog("Quit", "Save changes?", default_button_yes=True):
+        if self.persistence.save_needed(self.outline):
+            answer = self.show_yesno_dialog("Quit", "Save changes?", default_button_yes=True)
+            if answer:
                 # todo: return into program with resp=None (escape key)
-                self.persistence.save(self.treestore, backup=True)
+                self.persistence.save(self.outline, backup=True)
+            elif answer is False:
+                self.persistence.journal.discard() # changes dismissed
+        self.persistence.journal.stop()
         Gtk.main_quit()
 
 
     def on_save_clicked(self, widget):
+        self.flush_text()
         self.update_settings() # read eg last path
         self.persistence.save_settings() # write eg last path to file   
         # self.save(backup=False)
-        self.persistence.save(self.treestore, backup=False)
-        mypath = self._current_path()
-        # instant reload to reflect text entered ## headings as nodes
-        self.treestore = self.persistence.load(self.treestore) #, self.persistence.setting['filename'])
-        # path = self.persistence.setting['last_path']
-        # self.select_last_path(path)
-        # self.select_last_path(str(path))
-        self.select_last_path(str(mypath))
+        self.save_and_reload()
 
         # self.window.set_title(PROGRAM_NAME + ' saved')
         self.label_status.set_text(' saved. ')
-        while Gtk.events_pending(): Gtk.main_iteration()
-        time.sleep(1.5)
-        # self.window.set_title(PROGRAM_NAME)
-        self.label_status.set_text('')
-        while Gtk.events_pending(): Gtk.main_iteration()
+        if self.status_source is not None: # saved again before it cleared
+            GLib.source_remove(self.status_source)
+        self.status_source = GLib.timeout_add(STATUS_MS, self.on_status_timeout)
 
         # set breadcrumb
         # self.on_treeview_selection_changed( ...
 
+    def on_status_timeout(self):
+        self.status_source = None
+        self.label_status.set_text('')
+        return False
+
+    def load(self, filename=None): # read notes into the outline and show them
+        self.persistence.load(self.outline, filename)
+        self.undo.clear() # node ids start again
+        self.text_node = None
+        self.flush_text() # drops edits of the former outline, callers flushed them before saving
+        self.build_view()
+        if self.persistence.mapped is None: # else read the bodies at the first search
+            self.finder.search_index.build(self.outline)
+
+    def save_and_reload(self):
+        self.flush_text()
+        self.persistence.save(self.outline, backup=False)
+        # text entered ## headings as nodes, split off the edited nodes only
+        # (and to keep the tree as the journal will find it in the file)
+        self.update_outline(self.persistence.resection)
+
     def _current_path(self):
         path = 0
         model, iter = self.treeview_selection.get_selected() # self.treeview.get_selection()
@@ -676,6 +1079,7 @@ class Gui:
 
 
     def on_export_html_clicked(self, widget):
+        self.flush_text()
         homefolder = os.path.expanduser("~/")
         exportfilename = self.show_file_chooser("Select target file", "file", homefolder)
         # print 'exportfilename', exportfilename
@@ -686,13 +1090,30 @@ class Gui:
                 if self.show_yesno_dialog("File exists", "Overwrite %s?" % exportfilename):
                     exp = True
             if exp:
-                success, filename = self.persistence.store_html(self.treestore, exportfilename)
+                success, filename = self.persistence.store_html(self.outline, exportfilename)
                 if success:
                     if self.show_yesno_dialog("Export", "Open %s?" % filename, default_button_yes=True):
+                        import webbrowser
                         webbrowser.open(filename)
                 else:
                     self.show_message("Export", "Export failed.")
 
+    def on_export_site_clicked(self, widget):
+        self.flush_text()
+        homefolder = os.path.expanduser("~/")
+        folder = self.show_file_chooser("Select target folder", "folder", homefolder)
+        if folder is not False:
+            success, filename = self.persistence.store_site(self.outline, folder)
+            if success:
+                report = self.persistence.export_report
+                text = "%i of %i pages written, %.0f pages/s with %i processes.\nOpen %s?" % (report['written'],
+                    report['pages'], report['pages_per_second'], report['processes'], filename)
+                if self.show_yesno_dialog("Export", text, default_button_yes=True):
+                    import webbrowser
+                    webbrowser.open(filename)
+            else:
+                self.show_message("Export", "Export failed.")
+
     # dialogs
     def show_message(self, title, text):
         message = Gtk.MessageDialog(self.window, Gtk.DialogFlags.MODAL,
@@ -744,6 +1165,663 @@ class Gui:
 
 
 
+def read_sections(filename):
+    '''(sections, MappedFile or None) of a notes file, see iter_sections; big files are mapped'''
+    stamp = file_stamp(filename)
+    if stamp is not None and stamp[0] >= max(LAZY_LOAD_SIZE, 1):
+        mapped = MappedFile(filename)
+        check_utf8(mapped.map)
+        if not has_odd_eol(mapped.map): # else split exactly like read_lines
+            return iter_mapped_sections(mapped), mapped
+    return iter_sections(read_lines(filename)), None
+
+
+def snapshot_name():
+    return os.path.splitext(JSETFP)[0] + SNAPSHOT_SUFFIX
+
+
+def file_digest(filename):
+    '''md5 of the content of filename'''
+    digest = hashlib.md5()
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(COPY_BLOCK), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_snapshot(filename):
+    '''read_sections from the snapshot without parsing, None if it is not of filename as it is now'''
+    try:
+        with open(snapshot_name(), 'rb') as fh:
+            if marshal.load(fh) != (SNAPSHOT_VERSION, os.path.abspath(filename), file_stamp(filename)):
+                return None
+            digest, mapped, sections = marshal.load(fh)
+        if digest != file_digest(filename): # same size and mtime, other content
+            return None
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if mapped:
+        mapped = MappedFile(filename)
+        return ({'desc': desc if type(desc) is str else mapped.span(*desc), 'title': title, 'level': level}
+            for title, level, desc in sections), mapped
+    return ({'desc': desc, 'title': title, 'level': level} for title, level, desc in sections), None
+
+
+def write_snapshot(filename, stamp, sections):
+    '''store sections, [(title, level, desc)] parsed from filename with stamp, for read_snapshot; runs in a thread'''
+    try:
+        digest = file_digest(filename)
+        if file_stamp(filename) != stamp:
+            return # changed since parsed
+        mapped = any(type(desc) is tuple for title, level, desc in sections)
+        sections = [(title, level, desc if type(desc) is str else desc[1:]) for title, level, desc in sections]
+        name = snapshot_name()
+        with open(name + '.tmp', 'wb') as fh:
+            marshal.dump((SNAPSHOT_VERSION, os.path.abspath(filename), stamp), fh) # checked first
+            marshal.dump((digest, mapped, sections), fh)
+        os.rename(name + '.tmp', name)
+    except (IOError, OSError), e:
+        print 'error writing snapshot', e
+    except Exception:
+        if os is not None: # not a module emptied by the interpreter exiting, the snapshot is parsed again then
+            raise
+
+
+def check_utf8(data):
+    '''fail on bad utf-8 like codecs.open'''
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for start in xrange(0, len(data), UTF8_BLOCK):
+        decoder.decode(data[start:start + UTF8_BLOCK])
+    decoder.decode('', True)
+
+
+def has_odd_eol(data):
+    '''True if data has line ends besides '\n' and '\r\n', see RE_ODD_EOL'''
+    for start in xrange(0, len(data), SCAN_BLOCK):
+        block = data[start:start + SCAN_BLOCK + 2] # overlap for multi byte line ends
+        if block[-1:] == '\r' and start + len(block) < len(data): # its '\n' may follow, the next block has both
+            block = block[:-1]
+        for char in ('\r', '\x0b', '\x0c', '\x1c', '\x1d', '\x1e', '\xc2\x85', '\xe2\x80'):
+            if char in block: # fast scans before the slow regex
+                if RE_ODD_EOL.search(block):
+                    return True
+                break
+    return False
+
+
+def read_lines(filename):
+    '''read an utf-8 file as list of lines (str) without line ends'''
+    with open(filename, 'rb') as fh:
+        data = fh.read()
+    check_utf8(data)
+    if has_odd_eol(data): # rare: split exactly like codecs readlines()
+        return [line.encode('utf-8').rstrip('\n') for line in data.decode('utf-8').splitlines(True)]
+    lines = data.split('\n')
+    if lines[-1] == '':
+        lines.pop() # text after the last '\n'
+    return lines
+
+
+def iter_sections(lines):
+    '''tokenize lines into sections {'desc', 'title', 'level'} in one pass'''
+    # title = None # "<%s>" % os.path.basename(self.filename)
+    title = BLANK_NODE
+    level = 1 # 0
+    desc = [] # lines of the current section
+    line_previous = ''
+
+    for line in lines:
+        inhead = False
+        section = None
+        if (line and line[0] in HEAD_CHARS) or '<h' in line: # cheap test before the regexes
+            # check for ### hash symbole style headings
+            m = RE_HASH_HEADING.match(line)
+            if m and line_previous == "": # require empty line above # heading
+                inhead = True
+                # store old values into section
+                section = {'desc': _join_desc(desc), 'title': title, 'level': level}
+                # new values:
+                level = len(m.group('hdr')) # len('####')
+                title = m.group('title')
+                desc = []
+
+            # the following searches are for importing other markdown style headings only
+            # could use pandoc to convert html and others to markdown
+
+            # check for html head element headings like <h2 a=''>..</h2>
+            m = RE_HTML_HEADING.search(line)
+            if m:
+                inhead = True
+                section = {'desc': _join_desc(desc), 'title': title, 'level': level}
+                level = int(m.group('hlev')) # html h1..h9
+                title = m.group('title')
+                desc = []
+
+            # check for ==== ---- style headings
+            for regex, setext_level in ((RE_SETEXT_H1, 1), (RE_SETEXT_H2, 2)):
+                if regex.match(line):
+                    inhead = True
+                    # the title is the last line of desc, without its line end
+                    section = {'desc': '\n'.join(desc[:-1]), 'title': title, 'level': level}
+                    title = desc[-1]
+                    level = setext_level
+                    desc = []
+
+        if not inhead:
+            desc.append(line)
+        else:
+            yield section
+
+        line_previous = line
+
+    if desc:
+        # last section text
+        yield {'desc': _join_desc(desc), 'title': title, 'level': level}
+
+
+def iter_mapped_sections(mapped):
+    '''iter_sections for a MappedFile, with bodies as spans instead of text'''
+    data = mapped.map
+    size = len(data)
+    title = BLANK_NODE
+    level = 1
+    desc_start = 0 # the body are the lines from here to the current line
+
+    for start, end in iter_candidate_lines(data):
+        position = end + 1 # start of the next line
+        line = data[start:end]
+        section = None
+
+        m = RE_HASH_HEADING.match(line)
+        if m and (start < 2 or data[start - 2] == '\n'): # empty line above
+            section = {'desc': mapped.span(desc_start, start), 'title': title, 'level': level}
+            level = len(m.group('hdr'))
+            title = m.group('title')
+            desc_start = position
+
+        m = RE_HTML_HEADING.search(line)
+        if m:
+            section = {'desc': mapped.span(desc_start, start), 'title': title, 'level': level}
+            level = int(m.group('hlev'))
+            title = m.group('title')
+            desc_start = position
+
+        for regex, setext_level in ((RE_SETEXT_H1, 1), (RE_SETEXT_H2, 2)):
+            if regex.match(line):
+                if desc_start >= start:
+                    raise IndexError('no title above %s' % line) # like iter_sections
+                newline = data.rfind('\n', desc_start, start - 1)
+                title_start = desc_start if newline == -1 else newline + 1
+                section = {'desc': mapped.span(desc_start, title_start - 1), 'title': title, 'level': level}
+                title = data[title_start:start - 1] # the line above
+                level = setext_level
+                desc_start = position
+
+        if section is not None:
+            yield section
+
+    if desc_start < size:
+        yield {'desc': mapped.span(desc_start, size, data[size - 1] != '\n'), 'title': title, 'level': level}
+
+
+def iter_candidate_lines(data):
+    '''(start, end) of the lines starting with HEAD_CHARS or containing '<h', in order'''
+    size = len(data)
+    offset = 0
+    while offset < size: # in blocks of whole lines
+        end = offset + SCAN_BLOCK
+        if end < size:
+            end = data.rfind('\n', offset, end) + 1 or data.find('\n', end) + 1 or size
+        block = data[offset:end]
+        for start, end in iter_block_candidates(block):
+            yield offset + start, offset + end
+        offset += len(block)
+
+
+def iter_block_candidates(block):
+    '''iter_candidate_lines of a str starting at a line start'''
+    size = len(block)
+    needles = ['\n' + char for char in HEAD_CHARS] + ['<h']
+
+    def line_start(needle, position): # of the next line with needle from position
+        found = block.find(needle, position)
+        if found == -1:
+            return size + 1
+        if needle[0] == '\n':
+            return found + 1
+        return block.rfind('\n', 0, found) + 1
+
+    starts = [line_start(needle, 0) for needle in needles]
+    for i, char in enumerate(HEAD_CHARS):
+        if block[:1] == char: # first line, no '\n' before
+            starts[i] = 0
+    while True:
+        start = min(starts)
+        if start >= size:
+            break
+        end = block.find('\n', start)
+        if end == -1:
+            end = size
+        yield start, end
+        for i, needle in enumerate(needles):
+            if starts[i] <= end: # in this line
+                starts[i] = line_start(needle, end)
+
+
+# line edits of the text view, on utf-8 str without display, see Gui.replace_text
+
+def indent_lines(text): # a tab more at the start of each line
+    return '\t' + text.replace('\n', '\n\t')
+
+
+def unindent_lines(text): # a tab less at the start of each line having one
+    return '\n'.join(line[1:] if line[:1] == '\t' else line for line in text.split('\n'))
+
+
+def auto_indent(before, key):
+    '''edit after key changed the text view, before is the text from two lines above to the cursor;
+    (characters before the cursor to replace, new text) or None. The replaced text is ascii.'''
+    lines = before.split('\n')
+    if len(lines) > 1 and lines[-1] == '' and key not in ('BackSpace', 'Delete'): # new line
+        last = lines[-2]
+        rest = last.lstrip('\t')
+        tabs = last[:len(last) - len(rest)] # indent of the new line like the last
+        if rest[:2] == BULLET:
+            if len(rest) > len(BULLET): # text after the bullet: bullet again
+                return 0, tabs + BULLET
+            # bullet only: end of the list, with the line break before the bullet
+            return len(last) + 1 + (1 if len(lines) > 2 else 0), '\n\n'
+        if tabs and not rest: # tabs only: back to the start of the line
+            return len(last) + 1, '\n'
+        if tabs:
+            return 0, tabs
+        return None
+    if key == 'Tab' and before.endswith(BULLET + '\t'): # further indentation of a bullet
+        return len(BULLET) + 1, '\t' + BULLET
+    if key == 'BackSpace' and lines[-1][:1] == '\t' and lines[-1].lstrip('\t') + ' ' == BULLET: # outdent of a bullet
+        return len(lines[-1]), lines[-1][1:] + ' '
+    return None
+
+
+def find_spans(text, find_text, limit):
+    '''(start, end) character offsets of find_text in text ignoring case, both utf-8 str; at most limit'''
+    regex = re.compile(re.escape(find_text.decode('utf-8')), re.IGNORECASE | re.UNICODE)
+    spans = []
+    for match in regex.finditer(text.decode('utf-8')):
+        spans.append(match.span())
+        if len(spans) == limit:
+            break
+    return spans
+
+
+def section_markdown(title, desc, level):
+    '''markdown of one node; blank line before titles'''
+    # todo: make headline style configurable
+    # todo: displayed headings in desc?
+    chunk = ''
+    if title <> BLANK_NODE: # or not None
+        chunk = "\n" + level * '#' + ' ' + title + "\n"
+
+    desc = desc.rstrip("\n")
+    if len(desc) > 0:
+        chunk += desc + "\n"
+    return chunk
+
+
+def render_markdown(text):
+    '''html of markdown text, both utf-8 str'''
+    import markdown # slow to import, only exports need it
+    # Note: Markdown only accepts unicode input!
+    return markdown.markdown(text.decode('utf-8')).encode('utf-8')
+
+
+def markdown_version():
+    import markdown
+    return getattr(markdown, '__version__', getattr(markdown, 'version', ''))
+
+
+def file_stamp(filename):
+    '''[size, mtime] of filename, None if missing; for a workspace folder [size, [name, size, mtime] per
+    notes file], other files coming and going in it (eg .swp, the journal) leave it as it is'''
+    try:
+        stat = os.stat(filename)
+        if os.path.isdir(filename):
+            files = []
+            for name in workspace_files(filename):
+                stat = os.stat(name)
+                files.append([os.path.basename(name).decode('utf-8', 'replace'), stat.st_size, stat.st_mtime]) # as json
+            return [sum(size for name, size, mtime in files), files]
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime]
+
+
+def workspace_files(folder):
+    '''notes files of a workspace folder, sorted'''
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder)
+        if os.path.splitext(name)[1].lower() in WORKSPACE_SUFFIXES and not name.startswith('.')
+        and os.path.isfile(os.path.join(folder, name)))
+
+
+def add_sections(outline, sections, parent_id=None, parsed=None):
+    '''add sections {'desc', 'title', 'level'} below parent_id; parsed collects (title, level, desc);
+    True if a heading is more than one level below the one before, the ids may not follow the tree then'''
+    parent = parent_id
+    heading_path = {} #= {0:None}
+    jumped = False
+    level_before = 0
+    for section in sections:
+        title = section['title']
+        desc = section['desc']
+        level = section['level']
+        if parsed is not None:
+            parsed.append((title, level, desc))
+        jumped = jumped or level > level_before + 1
+        level_before = level
+        heading_path[level] = parent
+        try:
+            parent = heading_path[level - 1]
+        except KeyError:
+            parent = parent_id
+        heading = outline.add(parent, title, desc)
+        heading_path[level] = heading
+    return jumped
+
+
+def id_runs(ids):
+    '''[[first, count], ...] of consecutive ids in ids, short for ids added and moved in a few places'''
+    runs = []
+    for node_id in ids:
+        if runs and runs[-1][0] + runs[-1][1] == node_id:
+            runs[-1][1] += 1
+        else:
+            runs.append([node_id, 1])
+    return runs
+
+
+def _join_desc(lines):
+    if lines:
+        return '\n'.join(lines) + '\n'
+    return ''
+
+
+
+
+class LRU(object): # values by key, least recently used dropped above a size budget
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.used = 0
+        self.items = collections.OrderedDict() # key -> (value, size), oldest first
+
+
+    def get(self, key):
+        item = self.items.pop(key, None)
+        if item is None:
+            return None
+        self.items[key] = item # most recent
+        return item[0]
+
+
+    def put(self, key, value, size):
+        old = self.items.pop(key, None)
+        if old is not None:
+            self.used -= old[1]
+        if size > self.budget:
+            return
+        self.items[key] = (value, size)
+        self.used += size
+        while self.used > self.budget:
+            key, (value, size) = self.items.popitem(last=False)
+            self.used -= size
+
+
+
+
+class MappedFile(object): # read only memory map of a notes file, bodies cut out when used
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fh:
+            self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) # stays valid after a save renames over it
+            stat = os.fstat(fh.fileno())
+        self.stat = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime) # of the file as mapped
+        self.cache = LRU(BODY_CACHE_SIZE)
+
+
+    def changed_in_place(self): # the file was written over instead of renamed over, the map shows other bytes
+        try:
+            stat = os.stat(self.filename)
+        except OSError: # removed, the map keeps the old file
+            return False
+        return (stat.st_dev, stat.st_ino) == self.stat[:2] and (stat.st_size, stat.st_mtime) != self.stat[2:]
+
+
+    def close(self): # bodies still pointing here raise ValueError when read, instead of a bus error past the end
+        self.map.close()
+        self.cache = LRU(BODY_CACHE_SIZE)
+
+
+    def span(self, start, end, newline=False): # body of bytes start..end, plus a '\n' if newline
+        if start >= end:
+            return ''
+        return (self, start, end, newline)
+
+
+    def read(self, span):
+        desc = self.cache.get(span)
+        if desc is None:
+            desc = self.map[span[1]:span[2]]
+            if span[3]:
+                desc += '\n'
+            self.cache.put(span, desc, len(desc))
+        return desc
+
+
+
+
+class Node(object): # one heading of the notes with its text
+    __slots__ = ('id', 'title', 'body', 'parent', 'children')
+
+    def __init__(self, id, title, desc, parent):
+        self.id = id
+        self.title = title # utf-8 str
+        self.body = desc # desc, or its span in a MappedFile until changed
+        self.parent = parent # Node, Outline.root for top level nodes
+        self.children = [] # Nodes in file order
+
+    def get_desc(self): # utf-8 str
+        if type(self.body) is tuple:
+            return self.body[0].read(self.body)
+        return self.body
+
+    def set_desc(self, desc):
+        self.body = desc
+
+    desc = property(get_desc, set_desc)
+
+
+
+
+class Outline(object): # tree of the notes, usable without a display
+
+    def __init__(self):
+        self.root = Node(None, None, None, None) # parent of the top level nodes
+        self.nodes = {} # id -> Node
+        self.next_id = 0
+        self.observers = [] # called with (event, node, extra) after every change
+
+
+    def notify(self, event, node, extra=None):
+        for observer in self.observers:
+            observer(event, node, extra)
+
+
+    def clear(self):
+        self.root.children = []
+        self.nodes = {}
+        self.next_id = 0
+        self.notify('clear', self.root)
+
+
+    def add(self, parent_id, title, desc, position=None, node_id=None): # new child of parent_id, return its id
+        parent = self.root if parent_id is None else self.nodes[parent_id]
+        if node_id is None:
+            node_id = self.next_id
+        self.next_id = max(self.next_id, node_id + 1)
+        node = Node(node_id, title, desc, parent)
+        self.nodes[node_id] = node
+        if position is None:
+            position = len(parent.children)
+        parent.children.insert(position, node)
+        self.notify('insert', node, position)
+        return node_id
+
+
+    def remove(self, node_id): # node and its children
+        node = self.nodes.pop(node_id)
+        position = self.position(node)
+        del node.parent.children[position]
+        for child, level in self.walk(node):
+            del self.nodes[child.id]
+        self.notify('delete', node, position)
+
+
+    def move(self, node_id, parent_id, position): # make node child number position of parent_id
+        node = self.nodes[node_id]
+        old_parent = node.parent
+        old_position = self.position(node)
+        del old_parent.children[old_position]
+        node.parent = self.root if parent_id is None else self.nodes[parent_id]
+        node.parent.children.insert(position, node)
+        self.notify('move', node, (old_parent, old_position, position))
+
+
+    def set_title(self, node_id, title):
+        node = self.nodes[node_id]
+        node.title = title
+        self.notify('title', node)
+
+
+    def set_desc(self, node_id, desc, deltas=None): # deltas: text edits leading to desc, see Journal
+        node = self.nodes[node_id]
+        node.desc = desc
+        self.notify('desc', node, deltas)
+
+
+    def position(self, node): # index among its siblings
+        return node.parent.children.index(node)
+
+
+    def path(self, node_id): # positions from the top, like a tree path
+        node = self.nodes[node_id]
+        path = []
+        while node is not self.root:
+            path.append(self.position(node))
+            node = node.parent
+        path.reverse()
+        return path
+
+
+    def previous(self, node): # the node before node in file order, None for the first
+        parent = node.parent
+        position = self.position(node)
+        if position == 0:
+            return None if parent is self.root else parent
+        node = parent.children[position - 1]
+        while node.children:
+            node = node.children[-1]
+        return node
+
+
+    def following(self, node): # the node after node and its children in file order, None at the end
+        while node.parent is not None and node.parent.children[-1] is node:
+            node = node.parent
+        if node.parent is None:
+            return None
+        return node.parent.children[self.position(node) + 1]
+
+
+    def titles(self, node_id): # titles from the top down to node_id, as in the breadcrumb
+        node = self.nodes[node_id]
+        titles = []
+        while node is not self.root:
+            titles.append(node.title)
+            node = node.parent
+        titles.reverse()
+        return titles
+
+
+    def renumber(self, nodes, new_ids=None): # give all nodes new_ids (default 0, 1, 2...) in order; old id -> new id
+        ids = {}
+        self.nodes = {}
+        for node, new_id in itertools.izip(nodes, itertools.count() if new_ids is None else new_ids):
+            ids[node.id] = new_id
+            node.id = new_id
+            self.nodes[node.id] = node
+        self.next_id = max(self.nodes) + 1 if self.nodes else 0
+        return ids
+
+
+    def walk(self, top=None):
+        '''yield (node, level) below top (default all) in file order, without recursion'''
+        if top is None:
+            top = self.root
+        stack = [(node, 1) for node in reversed(top.children)]
+        while stack:
+            node, level = stack.pop()
+            yield node, level
+            stack.extend((child, level + 1) for child in reversed(node.children))
+
+
+    def walk_from(self, node):
+        '''yield (node, level) from node to the end in file order, like walk'''
+        chain = [] # node and its parents
+        while node is not self.root:
+            chain.append(node)
+            node = node.parent
+        stack = [] # later siblings, of the top level node lowest
+        for level, node in enumerate(reversed(chain), 1):
+            siblings = node.parent.children
+            stack.extend((sibling, level) for sibling in reversed(siblings[self.position(node) + 1:]))
+        stack.append((chain[0], len(chain)))
+        while stack:
+            node, level = stack.pop()
+            yield node, level
+            stack.extend((child, level + 1) for child in reversed(node.children))
+
+
+
+
+class ViewChanges(object): # the rows of a view of the outline that changes affect, see Gui.update_rows
+
+    def __init__(self):
+        self.spans = {} # parent node -> [children kept at the start, children kept at the end]
+        self.titles = set() # nodes with a new title
+
+
+    def on_outline_changed(self, event, node, extra): # observer of the outline while it changes
+        if event == 'insert':
+            self.touch(node.parent, extra, len(node.parent.children) - extra - 1)
+        elif event == 'delete':
+            self.touch(node.parent, extra, len(node.parent.children) - extra)
+        elif event == 'move':
+            old_parent, old_position, position = extra
+            length = len(old_parent.children) - (old_parent is node.parent) # before node came in again
+            self.touch(old_parent, old_position, length - old_position)
+            self.touch(node.parent, position, len(node.parent.children) - position - 1)
+        elif event == 'title':
+            self.titles.add(node)
+
+
+    def touch(self, parent, head, tail): # children of parent changed, except head of them and tail at the end
+        span = self.spans.setdefault(parent, [head, tail])
+        span[0] = min(span[0], head)
+        span[1] = min(span[1], tail)
+
+
+
+
 class Persistence(object):
     def __init__(self):
         # self.filename = FOLDER + "/" + FILE_DEFAULT
@@ -752,30 +1830,173 @@ class Persistence(object):
         self.setting = {}
         self.load_settings()
         #self.filename = self.setting['filename']
-
-    def save_needed(self, treestore):
-        self.treestore = treestore
-        markd = self.as_markdown()
-        # load file again to compare
-        try:
-            # print 'comparing memory markd to', self.setting['filename']
-            with codecs.open(self.setting['filename'], 'r', encoding='utf-8') as fh:
-                markd_disk = fh.read()
-                markd_disk = markd_disk.encode('utf-8')
-                # print type(markd), type(markd_disk)
-                if markd == markd_disk: # UnicodeWarning
-                    return False
-                else:
-                    # print markd
-                    return True
-        except IOError:
-            # file doesnt exist yet
+        self.generation = 0 # counts tree edits, see mark_changed
+        self.saved_generation = 0 # generation when last loaded or saved
+        self.section_hashes = {} # id(node.body) -> (body, title, level, length, md5) of last save
+        self.journal = Journal()
+        self.save_report = {} # seconds and bytes of the last save
+        self.mapped = None # MappedFile holding the bodies of the last load, if big
+        self.export_report = {} # seconds and sections rendered of the last export
+        self.snapshot_thread = None # writes the snapshot after a load that parsed
+        self.workspace = None # Workspace if a folder is loaded
+        self.database = None # Database if the notes are kept in sqlite
+        self.merge_report = {} # nodes added, removed and changed by the last merge
+        self.dirty = set() # ids of nodes whose sections may differ from a load of the file, see resection
+        self.dirty_after = set() # ids of nodes whose following node is dirty, see Outline.following
+        self.reordered = False # nodes added, removed or moved since, ids differ from a load of the next save
+        self.resection_report = {} # seconds and nodes of the last resection
+
+    def wait_snapshot(self): # until the snapshot of the last load is written
+        if self.snapshot_thread is not None:
+            self.snapshot_thread.join()
+
+    def mark_changed(self): # called for every edit of the tree
+        self.generation += 1
+
+    def on_outline_changed(self, event, node, extra): # observer of the outline
+        self.mark_changed()
+        if event in ('insert', 'move', 'title', 'desc'):
+            self.dirty.add(node.id)
+        if event in ('insert', 'move'): # and the node after it, eg untitled text now joining it
+            position = extra if event == 'insert' else extra[2]
+            if position + 1 < len(node.parent.children):
+                self.dirty.add(node.parent.children[position + 1].id)
+            elif node.parent.parent is not None: # after its parent, found once by resection for many appends
+                self.dirty_after.add(node.parent.id)
+        if event in ('insert', 'delete', 'move'):
+            self.reordered = True
+        if event in ('delete', 'move'): # the nodes around the gap meet
+            parent, position = (node.parent, extra) if event == 'delete' else extra[:2]
+            if event == 'move' and node.parent is parent and extra[2] <= position:
+                position += 1 # moved up within parent
+            if position < len(parent.children): # resection takes the one before it too
+                self.dirty.add(parent.children[position].id)
+            elif position > 0:
+                before = parent.children[position - 1]
+                while before.children:
+                    before = before.children[-1]
+                self.dirty.add(before.id)
+            elif parent.parent is not None:
+                self.dirty.add(parent.id)
+        if self.workspace is not None:
+            self.workspace.on_outline_changed(event, node, extra)
+        if self.database is not None:
+            self.database.on_outline_changed(event, node, extra)
+        journal = self.journal
+        if journal.notesname is None: # not recording, eg loading
+            return
+        if event == 'insert':
+            journal.record('insert', node.id, parent=node.parent.id, position=extra,
+                title=node.title, desc=node.desc)
+        elif event == 'delete':
+            journal.record('delete', node.id)
+        elif event == 'move':
+            journal.record('move', node.id, parent=node.parent.id, position=extra[2])
+        elif event == 'title':
+            journal.record('title', node.id, title=node.title)
+        elif event == 'desc':
+            if extra is None:
+                journal.record('desc', node.id, desc=node.desc)
+            else: # the edits are smaller than the text
+                for op, values in extra:
+                    journal.record(op, node.id, **values)
+
+    def changed_on_disk(self): # notes written by another program since the last load or save
+        journal = self.journal
+        return journal.notesname is not None and file_stamp(journal.notesname) not in (journal.base, None)
+
+    def merge(self, outline):
+        '''take the notes file as another program left it, unsaved edits are lost; old id -> new id and
+        ids of the nodes with a new text, or None if the notes have to be loaded again'''
+        filename = self.journal.notesname
+        if self.workspace is not None or self.database is not None:
+            return None
+        if self.mapped is not None and self.mapped.changed_in_place(): # the old texts are gone, reading them can crash
+            self.mapped.close()
+            self.mapped = None
+            return None
+        start = time.time()
+        sections, mapped = read_sections(filename)
+        sections = list(sections) # parse errors raise here, the journal still has the unsaved edits
+        self.journal.stop() # the merge is no edit
+        ids, added, removed, changed, jumped = merge_sections(outline, sections) # ids as the journal finds them after a crash
+        if mapped is not None:
+            self.mapped = mapped
+        self.section_hashes = {}
+        self.saved_generation = self.generation
+        self.dirty = set()
+        self.dirty_after = set()
+        self.reordered = jumped # the next save writes the tree order
+        self.journal.discard() # the edits were dropped for the merged file
+        self.journal.order = None # ids as a load gives them
+        self.journal.start(filename)
+        self.merge_report = {'seconds': time.time() - start, 'added': added, 'removed': removed,
+            'changed': len(changed), 'nodes': len(outline.nodes)}
+        return ids, changed
+
+    def resection(self, outline):
+        '''after a save: make the tree what a load of the file gives, eg nodes of headings typed into texts,
+        parsing only around the nodes edited since the last load; None (the nodes keep their ids, the journal
+        has their order) and ids of the nodes with a new text, or None if the notes have to be loaded again'''
+        dirty, self.dirty = self.dirty, set()
+        dirty_after, self.dirty_after = self.dirty_after, set()
+        if self.database is not None: # loaded as saved, texts are not parsed
+            return None, []
+        filename = self.journal.notesname
+        start = time.time()
+        if self.workspace is not None: # the files written, each parsed whole
+            nodes = self.workspace.written
+            self.journal.stop() # the files have these sections already
+            changed = self.workspace.resection(outline)
+            reordered = True # a load numbers the files in name order
+        else:
+            nodes = set() # each with the node before it, whose text may end differently now
+            for node_id in dirty_after:
+                node = outline.nodes.get(node_id)
+                if node is not None:
+                    node = outline.following(node)
+                if node is not None:
+                    dirty.add(node.id)
+            for node_id in dirty:
+                node = outline.nodes.get(node_id)
+                if node is not None:
+                    nodes.update(node for node in (node, outline.previous(node)) if node is not None)
+            self.journal.stop() # the file has these sections already
+            changed = []
+            parsed = set()
+            for node in sorted(nodes, key=lambda node: outline.path(node.id)): # file order
+                if outline.nodes.get(node.id) is not node or node.id in parsed: # removed or done with a node before
+                    continue
+                resectioned = resection_node(outline, node, parsed)
+                if resectioned is None: # the caller loads, that restarts the journal
+                    return None
+                changed.extend(resectioned)
+            reordered = self.reordered
+        if reordered: # a load of the file numbers the nodes in file order, the journal renumbers them after a crash
+            self.journal.order = id_runs(node.id for node, level in outline.walk())
+        self.dirty = set()
+        self.dirty_after = set()
+        self.reordered = False
+        self.saved_generation = self.generation
+        self.journal.start(filename)
+        self.resection_report = {'seconds': time.time() - start, 'nodes': len(nodes), 'reordered': reordered}
+        return None, changed
+
+    def save_needed(self, outline):
+        self.outline = outline
+        if self.generation != self.saved_generation:
             return True
-
-    def save(self, treestore, backup=True):
-        self.treestore = treestore
-
-        markd = self.as_markdown()
+        # file doesnt exist yet?
+        return not os.path.exists(self.setting['filename'])
+
+    def save(self, outline, backup=True):
+        self.outline = outline
+        if self.workspace is not None:
+            self.save_workspace(outline, backup)
+            return
+        if self.database is not None: # no backup, the rows change in a transaction
+            self.save_database(outline)
+            return
 
         if backup:
             # print 'creating .backup(.backup)'
@@ -789,9 +2010,128 @@ class Persistence(object):
                 print 'error copying to .backup'
                 self.show_message('Warning', 'Could not create backup(s).')
 
-        with codecs.open(self.setting['filename'], "w", encoding="utf-8") as fh:
-            # fh.write(markd)
-            fh.write(markd.decode('utf-8'))
+        filename = os.path.realpath(self.setting['filename']) # keep symlinks
+        tempname = filename + '.tmp'
+        start = time.time()
+        index = None
+        if INCREMENTAL_SAVE:
+            index = self.read_index(filename)
+        old = index or []
+        sections = [] # [offset, length, md5] per node as written
+        hashes = {}
+        offset = 0
+        copied = written = 0
+        out = None # temp file, opened at the first changed section
+
+        try:
+            for node, level in self.outline.walk():
+                title, body = node.title, node.body # body: mapped bodies are read only if needed
+                chunk = None
+                cached = self.section_hashes.get(id(body))
+                if cached and cached[0] is body and cached[1] == title and cached[2] == level:
+                    length, digest = cached[3], cached[4] # unchanged node, skip hashing
+                else:
+                    desc = node.desc
+                    chunk = section_markdown(title, desc, level)
+                    length, digest = len(chunk), hashlib.md5(chunk).hexdigest()
+                    if desc != '\n' and (desc[-2:] != '\n\n' or desc[-3:] == '\n\n\n' or len(desc) == 2):
+                        self.dirty.add(node.id) # a load gives it other line ends, see resection
+                hashes[id(body)] = (body, title, level, length, digest)
+
+                section = [offset, length, digest]
+                if out is None:
+                    if len(sections) < len(old) and old[len(sections)] == section:
+                        sections.append(section) # same bytes already in the file
+                        offset += length
+                        continue
+                    out = self.open_temp(tempname, filename, offset)
+                    copied = offset
+                if chunk is None:
+                    chunk = section_markdown(title, node.desc, level)
+                out.write(chunk)
+                written += length
+                sections.append(section)
+                offset += length
+            if sections: # its text ends the file now, maybe without the blank line
+                self.dirty.add(node.id)
+
+            if out is None and (index is None or len(sections) < len(old)):
+                out = self.open_temp(tempname, filename, offset) # new file or cut at the end
+                copied = offset
+            if out is not None:
+                out.flush()
+                os.fsync(out.fileno())
+                out.close()
+                if os.path.exists(filename):
+                    shutil.copymode(filename, tempname)
+                os.rename(tempname, filename) # atomic replace
+        except:
+            if out is not None:
+                out.close()
+                os.remove(tempname)
+            raise
+
+        self.section_hashes = hashes
+        if out is not None:
+            self.write_index(filename, sections)
+        self.journal.clear() # the notes file has it all now
+        self.saved_generation = self.generation
+        self.save_report = {'seconds': time.time() - start, 'bytes_written': written,
+            'bytes_copied': copied, 'size': offset, 'incremental': index is not None}
+
+    def save_workspace(self, outline, backup):
+        '''write the notes files of the changed top level nodes'''
+        start = time.time()
+        files, written = self.workspace.save(outline, backup)
+        self.journal.clear()
+        self.saved_generation = self.generation
+        self.save_report = {'seconds': time.time() - start, 'bytes_written': written, 'bytes_copied': 0,
+            'size': file_stamp(self.workspace.folder)[0], 'incremental': True, 'files_written': files}
+
+    def save_database(self, outline):
+        '''write the rows of the changed nodes'''
+        start = time.time()
+        incremental = self.database.complete
+        rows = self.database.save(outline)
+        self.journal.clear()
+        self.saved_generation = self.generation
+        self.save_report = {'seconds': time.time() - start, 'rows_written': rows,
+            'size': file_stamp(self.database.filename)[0], 'incremental': incremental}
+
+    def open_temp(self, tempname, filename, length):
+        '''start temp file with the first length bytes of filename'''
+        out = open(tempname, 'wb')
+        if length:
+            with open(filename, 'rb') as fh:
+                while length > 0:
+                    block = fh.read(min(length, COPY_BLOCK))
+                    if not block:
+                        break
+                    out.write(block)
+                    length -= len(block)
+        return out
+
+    def read_index(self, filename):
+        '''sections of the sidecar index, None if missing or not matching filename'''
+        try:
+            with open(filename + INDEX_SUFFIX, 'rb') as fh:
+                index = json.load(fh)
+            stat = os.stat(filename)
+        except (IOError, OSError, ValueError):
+            return None
+        if index.get('size') != stat.st_size or index.get('mtime') != stat.st_mtime:
+            return None # file changed behind our back
+        return index['sections']
+
+    def write_index(self, filename, sections):
+        stat = os.stat(filename)
+        index = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sections': sections}
+        try:
+            with open(filename + INDEX_SUFFIX + '.tmp', 'wb') as fh:
+                json.dump(index, fh)
+            os.rename(filename + INDEX_SUFFIX + '.tmp', filename + INDEX_SUFFIX)
+        except (IOError, OSError), e:
+            print 'error writing index', e
 
     def save_settings(self):
         #conf = {'filename': self.filename}
@@ -826,154 +2166,145 @@ class Persistence(object):
         # else:
         #     print 'loaded setting from %s: %s' % (JSETFP, self.setting)
 
-    def load(self, treestore, filename = None):
+    def load(self, outline, filename = None, remember = True, journal = True):
         # todo: display headings in desc?
+        # journal=False: read only, eg for a command; the journal of a crashed or running gui stays as it is
 
         if not filename:
             filename = self.setting['filename'] # has default if new
+        if os.path.isdir(filename):
+            filename = os.path.normpath(filename) # journal beside the folder
         # print 'trying to open filename',filename
-        treestore.clear()
-
-        parent = None
-        heading_path = {} #= {0:None}
-        sections = []
-        # title = None # "<%s>" % os.path.basename(self.filename)
-        title = BLANK_NODE
-        level = 1 # 0
-        desc = ''
-        line = None
-        line_previous = ''
+        self.journal.stop()
+        outline.clear()
 
-        try:
+        stamp = file_stamp(filename)
+        parsed = None # sections for the snapshot if not read from it
+        self.workspace = None
+        self.database = None
 
-            with codecs.open(filename, 'r', encoding='utf-8') as fh:
-                # use different approach than by line?
-                for line_read in fh.readlines(): # has '\n' at the end
-                    line_read = line_read.encode('utf-8')
-                    line = line_read.rstrip("\n")
-                    inhead = False
-                    section = None
-                    # check for ### hash symbole style headings
-                    m = re.match(r'^(?P<hdr>#+) (?P<title>.*)#*$', line)
-                    if m and line_previous == "": # require empty line above # heading
-                        inhead = True
-                        # store old values into section
-                        section = {'desc':desc, 'title':title, 'level':level}
-                        # new values:
-                        level = len(m.group('hdr')) # len('####')
-                        title = m.group('title')
-                        desc = ''
-                    
-                    # the following re.search's for importing other markdown style headings only
-                    # could use pandoc to convert html and others to markdown
-
-                    # check for html head element headings like <h2 a=''>..</h2>
-                    m = re.search(r'<h(?P<hlev>\d).*?>(?P<title>.*)</h.>', line)
-                    if m:
-                        inhead = True
-                        # store old values into section
-                        section = {'desc':desc, 'title':title, 'level':level}
-                        # new values:
-                        level = int(m.group('hlev')) # html h1..h9
-                        title = m.group('title')
-                        desc = ''
-
-                    # check for ==== ---- style headings
-                    m = re.search(r'^={3,}', line)
-                    if m:
-                        #print line, desc.split('\n')[-2]
-                        inhead = True
-                        # store old values into section
-                        descr = "\n".join(desc.split("\n")[:-2]) # remove found title still in desc above
-                        section = {'desc':descr, 'title':title, 'level':level}
-                        # new values:
-                        title = desc.split('\n')[-2]
-                        level = 1
-                        desc = ''
-                    m = re.search(r'^-{3,}', line)
-                    if m:
-                        inhead = True
-                        # store old values into section
-                        descr = "\n".join(desc.split("\n")[:-2])
-                        section = {'desc':descr, 'title':title, 'level':level}
-                        # new values:
-                        title = desc.split('\n')[-2]
-                        level = 2
-                        desc = ''
-
-                    if not inhead:
-                        desc += line + '\n'
-                    else:
-                        # add title into desc fix
-                        # section['desc'] = '%s %s\n\n' % (section['level'] * '#', section['title'])
-                        sections.append(section)
-
-                    line_previous = line
-
-                if len(desc) > 0:
-                    # last section text
-                    # desc = desc.strip()
-                    # desc = '%s %s\n\n' % (level * '#', title) # title in desc?
-                    section = {'desc': desc, 'title': title, 'level': level}
-                    sections.append(section)
-        
-        except IOError, e:
-            print 'open error', e
-            sections.append({'desc': '\nWelcome to ilunote.', 'title': 'Welcome', 'level': 1})
-        else:
+        try:
+            if os.path.isdir(filename): # one top level node per notes file
+                self.workspace = Workspace(filename)
+                self.mapped = self.workspace.load(outline)
+                sections = []
+            elif is_database(filename): # a row per node, nothing to parse
+                self.database = Database(filename) # kept if missing, the first save creates it
+                self.database.load(outline)
+                self.mapped = None
+                sections = []
+            else:
+                snapshot = read_snapshot(filename)
+                if snapshot is None:
+                    sections, self.mapped = read_sections(filename)
+                    if remember: # snapshot of the file the gui opens
+                        parsed = []
+                else:
+                    sections, self.mapped = snapshot
+            loaded = True
+        except (IOError, OSError), e:
+            sys.stderr.write('open error %s\n' % e)
+            loaded = False
+            self.mapped = None
+            self.workspace = None
+            outline.clear() # files of a workspace read so far
+            sections = [{'desc': '\nWelcome to ilunote.', 'title': 'Welcome', 'level': 1}]
+
+        jumped = add_sections(outline, sections, parsed=parsed)
+
+        self.saved_generation = self.generation # appending rows was no edit
+        self.dirty = set()
+        self.dirty_after = set()
+        self.reordered = jumped # the next save writes the tree order
+        self.journal.order = None # ids as a load gives them, unless the journal has others
+        self.section_hashes = {}
+        if loaded and parsed is not None: # parse no more at the next start
+            self.snapshot_thread = threading.Thread(target=write_snapshot, args=(filename, stamp, parsed))
+            self.snapshot_thread.daemon = True # a snapshot not written is parsed again
+            self.snapshot_thread.start()
+
+        if journal:
+            if self.journal.replay(outline, filename, None if self.workspace is None else self.workspace.remap): # edits of a crashed session
+                self.mark_changed()
+            self.journal.start(filename)
+        if loaded:
             # loading succeeded
             self.setting['filename'] = filename
-            self.save_settings()
+            if remember: # the gui opens it next time
+                self.save_settings()
 
-        for section in sections:
-            title = section['title']
-            desc = section['desc']
-            level = section['level']
-            heading_path[level] = parent
-            try:
-                parent = heading_path[level - 1]
-            except KeyError:
-                parent = None
-            heading = treestore.append(parent, [title, desc])
-            heading_path[level] = heading
-
-        return treestore
+        self.outline = outline
+        return outline
 
     def as_markdown(self):
-        self.content = ''
-        rootiter = self.treestore.get_iter_first()
-        self.as_markdown_level(self.treestore, rootiter, 1)
-
-        return self.content
-
-    def as_markdown_level(self, treestore, treeiter, level):
-        '''recurse tree; append to content; blank line before titles'''
-        while treeiter != None:
-
-            title, desc = treestore[treeiter]
+        return ''.join(self.iter_markdown())
 
-            # todo: make headline style configurable
-            # todo: displayed headings in desc?
-            if title <> BLANK_NODE: # or not None
-                self.content += "\n" + level * '#' + ' ' + title + "\n"
-                # self.content += level * '#' + ' ' + title + "\n\n"
-  
-            if len(desc.rstrip("\n")) > 0:
-                self.content += desc.rstrip("\n") + "\n"
+    def iter_markdown(self):
+        for title, desc, level in self.iter_nodes():
+            yield section_markdown(title, desc, level)
 
-            if treestore.iter_has_child(treeiter):
-                childiter = treestore.iter_children(treeiter)
-                self.as_markdown_level(treestore, childiter, level + 1)
-            treeiter = treestore.iter_next(treeiter)
+    def iter_nodes(self):
+        '''walk tree without recursion; yield (title, desc, level) in file order'''
+        for node, level in self.outline.walk():
+            yield node.title, node.desc, level
 
     def as_html(self):
-        text = self.as_markdown()
-        # Note: Markdown only accepts unicode input!
-        return markdown.markdown(text.decode('utf-8')).encode('utf-8')
+        return '\n'.join(self.iter_html())
+
+    def iter_html(self):
+        '''html per section, rendered only if not in the cache of former exports'''
+        start = time.time()
+        cache = self.read_html_cache()
+        sections = rendered = 0
+        for text in self.iter_markdown_sections():
+            key = hashlib.md5(text).hexdigest()
+            html = cache.get(key)
+            if html is None:
+                html = render_markdown(text)
+                rendered += 1
+            cache.put(key, html, len(html))
+            sections += 1
+            if html:
+                yield html
+        self.write_html_cache(cache)
+        self.export_report = {'seconds': time.time() - start, 'sections': sections, 'rendered': rendered}
+
+    def iter_markdown_sections(self):
+        '''markdown of the titled nodes, untitled ones stay with the node above'''
+        text = []
+        for chunk in self.iter_markdown():
+            if text and chunk.startswith('\n#'): # blank line and heading: markdown starts afresh
+                yield ''.join(text)
+                text = []
+            text.append(chunk)
+        if text:
+            yield ''.join(text)
+
+    def read_html_cache(self):
+        cache = LRU(HTML_CACHE_SIZE)
+        try:
+            with open(self.setting['filename'] + HTML_CACHE_SUFFIX, 'rb') as fh:
+                stored = json.load(fh)
+        except (IOError, ValueError):
+            return cache
+        if stored.get('markdown') != markdown_version():
+            return cache # renders differently
+        for key, html in stored['sections']: # oldest first
+            html = html.encode('utf-8')
+            cache.put(key, html, len(html))
+        return cache
+
+    def write_html_cache(self, cache):
+        filename = self.setting['filename'] + HTML_CACHE_SUFFIX
+        stored = {'markdown': markdown_version(), 'sections': [[key, html] for key, (html, size) in cache.items.items()]}
+        try:
+            with open(filename + '.tmp', 'wb') as fh:
+                json.dump(stored, fh)
+            os.rename(filename + '.tmp', filename)
+        except (IOError, OSError), e:
+            print 'error writing html cache', e
 
-    def store_html(self, treestore, filename):
-        # print 'store html', filename
-        '''export to html file'''
+    def read_template(self):
         template = '<?xml version="1.0" encoding="UTF-8"?><html><body /></html>'
         try:
             with codecs.open(TEMPLATE_HTML, 'r', 'utf-8') as fh:
@@ -981,19 +2312,1020 @@ class Persistence(object):
                 template = template.encode('utf-8')
         except Exception, e:
             print 'error', e
+        return template
+
+    def store_html(self, outline, filename):
+        # print 'store html', filename
+        '''export to html file'''
+        template = self.read_template()
+        target = os.path.realpath(filename) # keep symlinks
+        tempname = target + '.tmp'
 
         try:
-            self.treestore = treestore
-            html = template.replace('<body />', '<body>%s</body>' % self.as_html())
-            with codecs.open(filename, 'w', 'utf-8') as fh:
-                # fh.write(html)
-                fh.write(html.decode('utf-8'))
+            self.outline = outline
+            parts = template.split('<body />') # head, tail
+            with open(tempname, 'w+b') as fh: # sections streamed, the document is never in memory
+                fh.write(parts[0])
+                if len(parts) > 1:
+                    start = fh.tell()
+                    fh.write('<body>')
+                    separator = ''
+                    for html in self.iter_html():
+                        fh.write(separator)
+                        fh.write(html)
+                        separator = '\n'
+                    fh.write('</body>')
+                    end = fh.tell()
+                    fh.write(parts[1])
+                for part in parts[2:]: # more markers get a copy of the body written above
+                    for offset in xrange(start, end, SCAN_BLOCK):
+                        position = fh.tell()
+                        fh.seek(offset)
+                        block = fh.read(min(SCAN_BLOCK, end - offset))
+                        fh.seek(position)
+                        fh.write(block)
+                    fh.write(part)
+            if os.path.exists(target):
+                shutil.copymode(target, tempname)
+            os.rename(tempname, target) # the former export stays until this one is complete
             #return True, filename
         except Exception, e:
             print 'error', e
+            if os.path.exists(tempname):
+                os.remove(tempname)
             return False, None
         return True, filename
 
+    def store_site(self, outline, folder, processes=None):
+        '''export one html page per node to folder, rendered by processes; (success, index page)'''
+        import multiprocessing
+        start = time.time()
+        processes = processes or multiprocessing.cpu_count()
+        parts = self.read_template().split('<body />')
+        try:
+            with open(os.path.join(folder, SITE_MANIFEST), 'rb') as fh:
+                manifest = json.load(fh) # page -> hash of its content when written
+        except (IOError, ValueError):
+            manifest = {}
+
+        pages = {}
+        jobs = [] # render_page arguments of the changed pages
+        for name, top, text in self.iter_site_pages(outline):
+            key = hashlib.md5('<body />'.join(parts) + top + text).hexdigest()
+            pages[name] = key
+            filename = os.path.join(folder, name)
+            if manifest.get(name) != key or not os.path.exists(filename):
+                jobs.append((filename, parts, top, text))
+
+        try:
+            if processes > 1 and len(jobs) > SITE_CHUNK:
+                pool = multiprocessing.Pool(processes)
+                try:
+                    for filename in pool.imap_unordered(render_page, jobs, SITE_CHUNK):
+                        pass
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for job in jobs:
+                    render_page(job)
+            removed = 0
+            for name in manifest:
+                if name not in pages and os.path.exists(os.path.join(folder, name)):
+                    os.remove(os.path.join(folder, name)) # node gone
+                    removed += 1
+            with open(os.path.join(folder, SITE_MANIFEST), 'wb') as fh:
+                json.dump(pages, fh)
+        except Exception, e:
+            print 'error', e
+            return False, None
+
+        seconds = time.time() - start
+        self.export_report = {'seconds': seconds, 'pages': len(pages), 'written': len(jobs), 'removed': removed,
+            'processes': processes, 'pages_per_second': len(jobs) / seconds if seconds else 0}
+        return True, os.path.join(folder, 'index.html')
+
+    def iter_site_pages(self, outline):
+        '''(file name, navigation html, markdown) of the index and of each node'''
+        import cgi
+        names = {None: 'index.html'}
+        used = set(names.values())
+        for node, level in outline.walk():
+            slug = re.sub(r'[^a-z0-9]+', '-', node.title.lower()).strip('-')[:40] or 'node'
+            if node.parent.id is not None:
+                slug = names[node.parent.id][:-len('.html')][:80] + '_' + slug
+            name = slug + '.html'
+            count = 1
+            while name in used:
+                count += 1
+                name = '%s-%i.html' % (slug, count)
+            used.add(name)
+            names[node.id] = name
+
+        def link(node):
+            return '<a href="%s">%s</a>' % (names[node.id], cgi.escape(node.title))
+
+        def children(node):
+            if not node.children:
+                return ''
+            return '<ul class="children">%s</ul>' % ''.join('<li>%s</li>' % link(child) for child in node.children)
+
+        yield 'index.html', '<p class="breadcrumb">%s</p>%s' % (PROGRAM_NAME, children(outline.root)), ''
+        for node, level in outline.walk():
+            crumbs = [] # like the breadcrumb in the window title
+            parent = node.parent
+            while parent is not outline.root:
+                crumbs.append(link(parent))
+                parent = parent.parent
+            crumbs.reverse()
+            crumbs.append(cgi.escape(node.title))
+            top = '<p class="breadcrumb"><a href="index.html">%s</a>%s%s</p>' % (PROGRAM_NAME, SEPN,
+                cgi.escape(SEPB).join(crumbs))
+            yield names[node.id], top + children(node), section_markdown(node.title, node.desc, 1)
+
+
+
+
+def render_page(job):
+    '''write a page of Persistence.store_site; job is (filename, template parts, navigation, markdown)'''
+    filename, parts, top, text = job
+    body = '<body>%s%s</body>' % (top, render_markdown(text))
+    with open(filename + '.tmp', 'wb') as fh:
+        fh.write(parts[0])
+        for part in parts[1:]:
+            fh.write(body)
+            fh.write(part)
+    os.rename(filename + '.tmp', filename)
+    return filename
+
+
+
+
+def parse_notes(filename):
+    '''[(title, level, desc)] of the sections of a notes file, run by the processes of Workspace.load'''
+    return [(section['title'], section['level'], section['desc']) for section in iter_sections(read_lines(filename))]
+
+
+
+
+class Workspace(object): # the notes files of a folder as one outline, a top level node per file
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.files = {} # node id of a top level node -> its notes file
+        self.titles = {} # node id of a top level node -> its title when its file was loaded or written
+        self.changed = set() # node ids of the top level nodes to write at the next save
+        self.written = [] # node ids of the top level nodes the last save wrote, see resection
+        self.load_report = {} # seconds and files of the last load
+
+
+    def load(self, outline, processes=None): # add the files below outline.root, return a MappedFile if any
+        import multiprocessing
+        start = time.time()
+        processes = processes or multiprocessing.cpu_count()
+        filenames = workspace_files(self.folder)
+        small = [filename for filename in filenames if os.path.getsize(filename) < LAZY_LOAD_SIZE] # big ones are mapped
+        parsing = set(small)
+        pool = None
+        if processes > 1 and len(small) > 1:
+            pool = multiprocessing.Pool(min(processes, len(small)))
+            results = pool.imap(parse_notes, small) # in order, the tree grows while later files are parsed
+        else:
+            results = (parse_notes(filename) for filename in small)
+
+        mapped = None
+        self.files = {}
+        self.titles = {}
+        try:
+            for filename in filenames:
+                if filename in parsing:
+                    sections = ({'title': title, 'level': level, 'desc': desc} for title, level, desc in next(results))
+                else:
+                    sections, big = read_sections(filename)
+                    mapped = mapped or big
+                node_id = outline.add(None, os.path.basename(filename), '')
+                self.files[node_id] = filename
+                self.titles[node_id] = os.path.basename(filename)
+                add_sections(outline, sections, node_id)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self.changed = set() # adding the files was no edit
+        self.load_report = {'seconds': time.time() - start, 'files': len(filenames), 'nodes': len(outline.nodes),
+            'processes': processes if pool is not None else 1}
+        return mapped
+
+
+    def remap(self, ids): # node ids renumbered, old -> new
+        self.files = dict((ids[node_id], filename) for node_id, filename in self.files.items())
+        self.titles = dict((ids[node_id], title) for node_id, title in self.titles.items())
+        self.changed = set(ids[node_id] for node_id in self.changed)
+
+
+    def top(self, node): # the top level node above node, or node
+        while node.parent.parent is not None:
+            node = node.parent
+        return node
+
+
+    def on_outline_changed(self, event, node, extra): # told by Persistence.on_outline_changed
+        if event == 'clear':
+            return
+        self.changed.add(self.top(node).id)
+        if event == 'move' and extra[0].parent is not None: # extra: the former parent and position, and the new one
+            self.changed.add(self.top(extra[0]).id)
+
+
+    def file_name(self, title): # a new notes file for a top level node titled title
+        name = re.sub(r'[^\w.-]+', '-', title).strip('-.') or 'notes'
+        if os.path.splitext(name)[1].lower() not in WORKSPACE_SUFFIXES:
+            name += WORKSPACE_SUFFIX
+        base, suffix = os.path.splitext(name)
+        filename = os.path.join(self.folder, name)
+        count = 1
+        while os.path.exists(filename):
+            count += 1
+            filename = os.path.join(self.folder, '%s-%i%s' % (base, count, suffix))
+        return filename
+
+
+    def save(self, outline, backup=True):
+        '''write the files of the changed top level nodes; (files written, bytes written)'''
+        files = {}
+        titles = {}
+        self.written = []
+        written = 0
+        for top in outline.root.children:
+            filename = self.files.get(top.id)
+            titles[top.id] = top.title
+            if filename is not None and top.id not in self.changed:
+                files[top.id] = filename
+                continue
+            if filename is None or self.titles.get(top.id) != top.title: # new or renamed
+                filename = self.file_name(top.title)
+            files[top.id] = filename
+            written += self.write(outline, top, filename, backup)
+            self.written.append(top.id)
+
+        kept = set(files.values())
+        for filename in self.files.values():
+            if filename not in kept and os.path.exists(filename): # its node was deleted, renamed or moved
+                os.rename(filename, filename + '.backup')
+        self.files = files
+        self.titles = titles
+        self.changed = set()
+        return len(self.written), written
+
+
+    def resection(self, outline):
+        '''after a save: make the nodes of the files written what a load gives, each file parsed whole, and the
+        top level nodes titled and ordered by their files; ids of the nodes with a new text'''
+        changed = []
+        for node_id in self.written:
+            top = outline.nodes[node_id]
+            sections = list(read_sections(self.files[node_id])[0])
+            if top.desc: # its text starts the file, a load puts it into the node below
+                outline.set_desc(node_id, '')
+                changed.append(node_id)
+            changed.extend(merge_sections(outline, sections, top)[3])
+        for position, top in enumerate(sorted(outline.root.children, key=lambda top: self.files[top.id])):
+            name = os.path.basename(self.files[top.id])
+            if top.title != name: # a new file named after its title
+                outline.set_title(top.id, name)
+                self.titles[top.id] = name
+            if outline.root.children[position] is not top:
+                outline.move(top.id, None, position)
+        self.changed = set() # the files have these nodes already
+        self.written = []
+        return changed
+
+
+    def write(self, outline, top, filename, backup): # the notes of top into filename, return bytes written
+        tempname = filename + '.tmp'
+        written = 0
+        try:
+            with open(tempname, 'wb') as out:
+                if top.desc: # text of the file node comes before the first heading
+                    chunk = section_markdown(BLANK_NODE, top.desc, 1)
+                    out.write(chunk)
+                    written += len(chunk)
+                for node, level in outline.walk(top):
+                    chunk = section_markdown(node.title, node.desc, level)
+                    out.write(chunk)
+                    written += len(chunk)
+                out.flush()
+                os.fsync(out.fileno())
+            if os.path.exists(filename):
+                if backup:
+                    shutil.copy2(filename, filename + '.backup')
+                shutil.copymode(filename, tempname)
+            os.rename(tempname, filename) # atomic replace
+        except:
+            if os.path.exists(tempname):
+                os.remove(tempname)
+            raise
+        return written
+
+
+
+
+def pair_keys(old_keys, new_keys):
+    '''(i, j) of old_keys[i] kept as new_keys[j]: equal keys, or replaced ones of the same depth (key[0])'''
+    import difflib
+    head = 0 # most edits leave the start and the end as they are
+    while head < min(len(old_keys), len(new_keys)) and old_keys[head] == new_keys[head]:
+        head += 1
+    tail = 0
+    while tail < min(len(old_keys), len(new_keys)) - head and old_keys[-1 - tail] == new_keys[-1 - tail]:
+        tail += 1
+    pairs = [(i, i) for i in range(head)] + [(len(old_keys) - 1 - i, len(new_keys) - 1 - i) for i in range(tail)]
+    matcher = difflib.SequenceMatcher(None, old_keys[head:len(old_keys) - tail], new_keys[head:len(new_keys) - tail],
+        False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag in ('equal', 'replace'): # replaced at the same depth: a changed node
+            pairs.extend((head + i1 + k, head + j1 + k) for k in range(min(i2 - i1, j2 - j1))
+                if tag == 'equal' or old_keys[head + i1 + k][0] == new_keys[head + j1 + k][0])
+    return pairs
+
+
+def merge_sections(outline, sections, top=None):
+    '''make outline the tree of sections, keeping the nodes of unchanged ones, with ids as a load gives them;
+    (old id -> new id, added, removed, old ids of the nodes with a new desc, True if levels jump as in add_sections).
+    With a top node only the nodes below it change, they keep their ids (None instead of old id -> new id)'''
+    def text(desc):
+        if type(desc) is tuple: # span of a mapped file
+            return desc[0].read(desc)
+        return desc
+    def key(depth, title, desc): # a collision at worst keeps another node, descs are compared below
+        return depth, title, hash(text(desc))
+
+    new = [] # (title, desc, index of the parent or None)
+    new_keys = []
+    depths = []
+    parent = None
+    heading_path = {} # as in add_sections
+    jumped = False
+    level_before = 0
+    for section in sections:
+        level = section['level']
+        jumped = jumped or level > level_before + 1
+        level_before = level
+        heading_path[level] = parent
+        parent = heading_path.get(level - 1)
+        depths.append(1 if parent is None else depths[parent] + 1)
+        new.append((section['title'], section['desc'], parent))
+        new_keys.append(key(depths[-1], section['title'], section['desc']))
+        heading_path[level] = len(new) - 1
+    old = list(outline.walk(top))
+    old_keys = [key(level, node.title, node.body) for node, level in old]
+
+    match = [None] * len(new) # old node kept for each new section
+    matched = set() # ids of the kept old nodes
+    for i, j in pair_keys(old_keys, new_keys):
+        match[j] = old[i][0]
+        matched.add(old[i][0].id)
+
+    kept = set() # ids of old nodes with a kept node in their subtree
+    for node, level in reversed(old):
+        if node.id in matched or node.id in kept:
+            kept.add(node.parent.id)
+    removed = 0
+    for node, level in old: # whole subtrees first, so kept nodes do not shift past them
+        if node.id not in matched and node.id not in kept and node.id in outline.nodes:
+            outline.remove(node.id)
+            removed += 1
+
+    added = 0
+    changed = []
+    nodes = [] # node of each new section
+    placed = collections.defaultdict(int) # id of a parent -> children in place
+    for (title, desc, parent), node in zip(new, match):
+        parent = (outline.root if top is None else top) if parent is None else nodes[parent]
+        position = placed[parent.id]
+        placed[parent.id] += 1
+        if node is None:
+            node = outline.nodes[outline.add(parent.id, title, desc, position)]
+            added += 1
+        else:
+            if position >= len(parent.children) or parent.children[position] is not node:
+                outline.move(node.id, parent.id, position)
+            if node.title != title:
+                outline.set_title(node.id, title)
+            if node.desc != text(desc):
+                outline.set_desc(node.id, desc)
+                changed.append(node.id)
+            elif type(node.body) is tuple:
+                node.body = desc # same text, from the new map
+        nodes.append(node)
+    for node, level in old: # headings gone, their children kept elsewhere
+        if node.id not in matched and node.id in outline.nodes:
+            outline.remove(node.id)
+            removed += 1
+    ids = outline.renumber(nodes) if top is None else None
+    return ids, added, removed, changed, jumped
+
+
+def resection_node(outline, node, parsed):
+    '''make the sections around node what a load of the saved notes gives, eg split at headings typed into
+    its desc; ids of the nodes with a new desc, or None if that needs the whole file. parsed collects the
+    ids of the resulting nodes, parsing them again could differ: a node without text ending the file is gone'''
+    start = node # a heading line starts the parse afresh, untitled nodes are text of the one before
+    while start.title == BLANK_NODE and outline.previous(start) is not None:
+        start = outline.previous(start)
+    at_start = outline.previous(start) is None
+    parents = [] # of start, as heading_path of add_sections has them
+    parent = start.parent
+    while parent is not outline.root:
+        parents.append(parent)
+        parent = parent.parent
+    parents.reverse()
+
+    window = [] # (node, level) of start and the untitled nodes after it
+    following = None # (node, level) of the next titled node
+    walk = outline.walk_from(start)
+    for node, level in walk:
+        if window and node.title != BLANK_NODE:
+            following = node, level
+            break
+        window.append((node, level))
+    text = ''.join(section_markdown(node.title, node.desc, level) for node, level in window)
+    if not at_start:
+        text = text[1:] # from the heading line of start
+    if has_odd_eol(text):
+        return None
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    if following is not None:
+        lines += ['', '# ...'] # a heading ends the last section
+    sections = list(iter_sections(lines))
+    if not at_start and (not sections or sections.pop(0) != {'desc': '', 'title': BLANK_NODE, 'level': 1}):
+        return None # the section before start
+
+    old_keys = [(level, node.title) for node, level in window]
+    new_keys = [(section['level'], section['title']) for section in sections]
+    if old_keys == new_keys: # same headings, descs as the file has them
+        changed = []
+        for (node, level), section in zip(window, sections):
+            parsed.add(node.id)
+            if node.desc != section['desc']:
+                outline.set_desc(node.id, section['desc'])
+                changed.append(node.id)
+        return changed
+
+    plan = [] # [node or None, title, desc or None if kept, level] in file order
+    match = dict((j, window[i][0]) for i, j in pair_keys(old_keys, new_keys))
+    for j, section in enumerate(sections):
+        plan.append([match.get(j), section['title'], section['desc'], section['level']])
+    lowest = min(key[0] for key in old_keys + new_keys)
+    if following is not None: # later nodes may get other parents, up to one as high as the changed ones
+        for node, level in itertools.chain([following], walk):
+            if level <= lowest:
+                break
+            plan.append([node, node.title, None, level])
+    previous = len(parents) # a deeper heading needs the nodes before start
+    for item in plan:
+        if item[3] > previous + 1:
+            return None
+        previous = item[3]
+
+    heading_path = dict(enumerate(parents, 1))
+    placed = {} # id of a parent -> position of its next child
+    for level, parent in enumerate([outline.root] + parents):
+        child = parents[level] if level < len(parents) else start
+        placed[parent.id] = outline.position(child) + (child is not start)
+    kept = set(id(node) for node in match.values())
+    changed = []
+    for node, title, desc, level in plan:
+        parent = heading_path.get(level - 1, outline.root)
+        position = placed.get(parent.id, 0)
+        placed[parent.id] = position + 1
+        if node is None:
+            node = outline.nodes[outline.add(parent.id, title, desc, position)]
+            parsed.add(node.id)
+        else:
+            if position >= len(parent.children) or parent.children[position] is not node:
+                outline.move(node.id, parent.id, position)
+            if node.title != title:
+                outline.set_title(node.id, title)
+            if desc is not None:
+                parsed.add(node.id)
+                if node.desc != desc:
+                    outline.set_desc(node.id, desc)
+                    changed.append(node.id)
+        heading_path[level] = node
+    for node, level in window: # headings gone, their children moved above
+        if id(node) not in kept and outline.nodes.get(node.id) is node:
+            outline.remove(node.id)
+    return changed
+
+
+def is_database(filename):
+    return os.path.splitext(filename)[1].lower() in DATABASE_SUFFIXES
+
+
+
+
+class Database(object): # the outline in a sqlite file, a row per node; saves write the changed rows
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = None # opened at the first load or save
+        self.complete = False # rows match the outline as of the last load or save
+        self.changed = set() # ids of new nodes or with a new title or desc
+        self.deleted = set() # ids of removed nodes
+        self.reordered = set() # ids of parents whose children changed places, None for the top level
+
+
+    def connect(self):
+        if self.connection is None:
+            import sqlite3
+            self.connection = sqlite3.connect(self.filename)
+            self.connection.text_factory = str # utf-8 like the rest of the notes
+            self.connection.executescript(DATABASE_SCHEMA)
+        return self.connection
+
+
+    def load(self, outline): # add the rows to the outline with their ids
+        if not os.path.exists(self.filename):
+            raise IOError(errno.ENOENT, 'No such file', self.filename) # not created until saved
+        import sqlite3
+        children = collections.defaultdict(list) # parent id -> rows of its children in order
+        try:
+            for row in self.connect().execute('SELECT id, parent, title, body FROM nodes ORDER BY parent, position'):
+                children[row[1]].append(row)
+        except sqlite3.DatabaseError, e: # eg not a database
+            raise IOError('%s: %s' % (self.filename, e))
+        stack = list(reversed(children.pop(None, [])))
+        while stack: # parents first
+            node_id, parent_id, title, body = stack.pop()
+            outline.add(parent_id, title, body, node_id=node_id)
+            stack.extend(reversed(children.pop(node_id, [])))
+        self.forget()
+        self.complete = True
+
+
+    def forget(self): # the rows are up to date
+        self.changed = set()
+        self.deleted = set()
+        self.reordered = set()
+
+
+    def on_outline_changed(self, event, node, extra): # told by Persistence.on_outline_changed
+        if event == 'clear':
+            self.complete = False
+        elif event == 'insert':
+            self.changed.add(node.id)
+            self.reordered.add(node.parent.id)
+        elif event == 'delete':
+            stack = [node] # with its children
+            while stack:
+                gone = stack.pop()
+                self.deleted.add(gone.id)
+                stack.extend(gone.children)
+            self.reordered.add(node.parent.id)
+        elif event == 'move': # extra: the former parent and position, and the new position
+            self.reordered.add(node.parent.id)
+            self.reordered.add(extra[0].id)
+        else:
+            self.changed.add(node.id)
+
+
+    def row(self, node, position):
+        return node.id, node.parent.id, position, node.title, node.desc
+
+
+    def save(self, outline): # write the changed rows in one transaction, return their number
+        connection = self.connect()
+        with connection:
+            if not self.complete:
+                connection.execute('DELETE FROM nodes')
+                rows = []
+                stack = [outline.root]
+                while stack: # parents first, with the positions of their children
+                    parent = stack.pop()
+                    rows.extend(self.row(child, position) for position, child in enumerate(parent.children))
+                    stack.extend(parent.children)
+                connection.executemany('INSERT INTO nodes VALUES (?, ?, ?, ?, ?)', rows)
+                count = len(rows)
+            else:
+                nodes = [outline.nodes[node_id] for node_id in self.changed if node_id in outline.nodes]
+                positions = {} # id -> position of the children of their parents
+                for parent in set(node.parent for node in nodes):
+                    positions.update((child.id, position) for position, child in enumerate(parent.children))
+                rows = [self.row(node, positions[node.id]) for node in nodes]
+                gone = [(node_id,) for node_id in self.deleted if node_id not in outline.nodes]
+                places = [] # (parent, position, id) of the children of reordered parents
+                for parent_id in self.reordered:
+                    parent = outline.root if parent_id is None else outline.nodes.get(parent_id)
+                    if parent is not None:
+                        places.extend((parent_id, position, child.id) for position, child in enumerate(parent.children))
+                connection.executemany('DELETE FROM nodes WHERE id = ?', gone)
+                connection.executemany('INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?, ?)', rows)
+                connection.executemany('UPDATE nodes SET parent = ?, position = ? WHERE id = ?', places)
+                count = len(rows) + len(places) + len(gone)
+        self.forget()
+        self.complete = True
+        return count
+
+
+
+
+class Journal(object): # append-only log of the edits since the last save
+
+    def __init__(self):
+        self.notesname = None # notes file the edits apply to, None = not recording
+        self.filename = None # the journal file
+        self.base = None # file_stamp of the notes file the records start from
+        self.order = None # ids of the nodes in file order as runs [first, count], None if as a load gives them
+        self.fh = None
+
+
+    def start(self, notesname): # record edits of notesname from now on
+        self.stop()
+        self.notesname = notesname
+        self.filename = notesname + JOURNAL_SUFFIX
+        self.base = file_stamp(notesname)
+
+
+    def stop(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+        self.notesname = None
+
+
+    def record(self, op, node_id, **values): # append one edit of node node_id
+        if self.notesname is None:
+            return
+        if self.fh is None:
+            new = not os.path.exists(self.filename) or os.path.getsize(self.filename) == 0
+            self.fh = open(self.filename, 'ab')
+            if new:
+                header = {'base': self.base}
+                if self.order is not None:
+                    header['ids'] = self.order
+                self.fh.write(json.dumps(header) + '\n')
+        values['op'] = op
+        values['id'] = node_id
+        self.fh.write(json.dumps(values) + '\n')
+        self.fh.flush() # survives a crash of the program
+
+
+    def size(self):
+        if self.fh is None:
+            return 0
+        return self.fh.tell()
+
+
+    def clear(self): # notes file saved, restart with an empty journal
+        self.discard()
+        if self.notesname is not None:
+            self.base = file_stamp(self.notesname)
+
+
+    def discard(self): # drop recorded edits
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+        if self.filename is not None and os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+    def replay(self, outline, notesname, remap=None): # apply edits left by a crashed session; remap(old id -> new id)
+        filename = notesname + JOURNAL_SUFFIX
+        try:
+            with open(filename, 'rb') as fh:
+                lines = fh.readlines()
+        except IOError:
+            return 0 # no journal
+        count = 0
+        valid = 0 # bytes of the journal replayed
+        try:
+            header = json.loads(lines[0])
+            if header.get('base') != file_stamp(notesname):
+                sys.stderr.write('discarding journal of another version of %s\n' % notesname)
+                os.remove(filename)
+                return 0
+            if header.get('ids') is not None: # the nodes kept their ids when the file was saved
+                nodes = [node for node, level in outline.walk()]
+                ids = list(itertools.chain.from_iterable(xrange(first, first + length) for first, length in header['ids']))
+                if len(ids) != len(nodes):
+                    raise ValueError('%i ids for %i nodes' % (len(ids), len(nodes)))
+                ids = outline.renumber(nodes, ids)
+                if remap is not None: # eg the files of a workspace by node id
+                    remap(ids)
+                self.order = header['ids']
+            valid = len(lines[0])
+            for line in lines[1:]:
+                self.apply(outline, json.loads(line))
+                count += 1
+                valid += len(line)
+        except (ValueError, KeyError, IndexError, TypeError), e: # eg last record cut by a crash
+            sys.stderr.write('journal error %s\n' % e)
+            with open(filename, 'r+b') as fh:
+                fh.truncate(valid) # append after the last good record
+        return count
+
+
+    def apply(self, outline, record):
+        op = record['op']
+        node_id = record['id']
+        values = {}
+        for k in ('title', 'desc', 'text'):
+            if record.get(k) is not None:
+                values[k] = record[k].encode('utf-8')
+
+        if op == 'insert':
+            outline.add(record['parent'], values.get('title'), values.get('desc'), record['position'], node_id)
+        elif op == 'delete':
+            outline.remove(node_id)
+        elif op == 'move':
+            outline.move(node_id, record['parent'], record['position'])
+        elif op == 'title':
+            outline.set_title(node_id, values['title'])
+        elif op == 'desc':
+            outline.set_desc(node_id, values['desc'])
+        elif op == 'insert_text':
+            desc = outline.nodes[node_id].desc.decode('utf-8') # offsets count characters
+            offset = record['offset']
+            desc = desc[:offset] + values['text'].decode('utf-8') + desc[offset:]
+            outline.set_desc(node_id, desc.encode('utf-8'))
+        elif op == 'delete_text':
+            desc = outline.nodes[node_id].desc.decode('utf-8')
+            desc = desc[:record['start']] + desc[record['end']:]
+            outline.set_desc(node_id, desc.encode('utf-8'))
+        else:
+            raise ValueError('unknown journal record %s' % op)
+
+
+
+
+class SearchIndex(object):
+    '''lowered titles and texts of all rows, searched block by block; texts still in a MappedFile are
+    not copied but searched in the map, so the index of a big file takes little memory'''
+
+    def __init__(self):
+        self.valid = False # False until built, and after the outline was cleared
+        self.ids = [] # per block: node id per row, in tree order
+        self.blocks = [] # per block of about SEARCH_BLOCK rows: their texts, each ended by '\0'
+        self.starts = [] # per block: offset of each row in the block
+        self.runs = [] # per block: (MappedFile, starts, ends, indexes) of texts in the map, in order within a run
+        self.firsts = [] # per block: row number of its first row
+        self.numbers = {} # id() of the ids of a block -> block number
+        self.block_of = {} # node id -> ids of its block
+        self.spans = {} # node id -> span of its text in a MappedFile, see Node.body
+        self.pending = {} # node id -> node changed since its block was built
+        self.placed = {} # id() -> node inserted, moved or deleted with its children, placed when searched next
+        self.version = 0 # changes whenever rows or their texts change
+
+
+    def build(self, outline): # index all nodes in tree order
+        self.ids = []
+        self.blocks = []
+        self.starts = []
+        self.runs = []
+        self.block_of = {}
+        self.spans = {}
+        self.pending = {}
+        self.placed = {}
+        nodes = []
+        for node, level in outline.walk():
+            nodes.append(node)
+            if len(nodes) == SEARCH_BLOCK:
+                self.add_block(len(self.ids), nodes)
+                nodes = []
+        if nodes or not self.ids: # a block to place new nodes in
+            self.add_block(len(self.ids), nodes)
+        self.count()
+        self.valid = True
+        self.version += 1
+
+
+    def row_text(self, name, desc):
+        return '%s\0%s\0' % ((name or '').lower(), (desc or '').lower()) # '\0' never in find text
+
+
+    def add_block(self, number, nodes): # new block number of nodes, see count
+        ids = [node.id for node in nodes]
+        self.ids.insert(number, ids)
+        self.blocks.insert(number, '')
+        self.starts.insert(number, [])
+        self.runs.insert(number, [])
+        for node_id in ids:
+            self.block_of[node_id] = ids
+        self.fill(number, nodes)
+
+
+    def fill(self, number, nodes): # texts of block number, nodes: those of its ids
+        texts = []
+        starts = []
+        runs = []
+        offset = 0
+        for index, node in enumerate(nodes):
+            span = node.body
+            if type(span) is tuple and not span[3]: # title only, the text stays in the map
+                self.spans[node.id] = span
+                text = self.row_text(node.title, '')
+                if not runs or runs[-1][0] is not span[0] or runs[-1][2][-1] > span[1]: # other map or back in it
+                    runs.append((span[0], [], [], []))
+                for values, value in zip(runs[-1][1:], (span[1], span[2], index)):
+                    values.append(value)
+            else: # eg the last text of a file without a final line end, given one when read
+                self.spans.pop(node.id, None)
+                text = self.row_text(node.title, node.desc)
+            starts.append(offset)
+            offset += len(text)
+            texts.append(text)
+        self.blocks[number] = ''.join(texts)
+        self.starts[number] = starts
+        self.runs[number] = runs
+
+
+    def count(self): # firsts and numbers of the blocks
+        self.firsts = []
+        self.numbers = {}
+        first = 0
+        for number, ids in enumerate(self.ids):
+            self.firsts.append(first)
+            self.numbers[id(ids)] = number
+            first += len(ids)
+
+
+    def block_number(self, row): # block of row, and the index of row in it
+        number = bisect.bisect_right(self.firsts, row) - 1 # empty blocks share the first row of the next
+        return number, row - self.firsts[number]
+
+
+    def row_id(self, row):
+        number, index = self.block_number(row)
+        return self.ids[number][index]
+
+
+    def invalidate(self):
+        self.valid = False
+
+
+    def on_outline_changed(self, event, node, extra): # observer of the outline
+        if not self.valid: # built with all changes
+            return
+        if event in ('title', 'desc'):
+            self.update(node)
+        elif event == 'clear':
+            self.invalidate()
+        else: # insert, delete or move
+            self.placed[id(node)] = node
+
+
+    def update(self, node): # node has a new title or desc
+        if self.valid:
+            self.pending[node.id] = node # lowered when searched next
+
+
+    def place(self, outline): # move the rows of placed nodes to their nodes in tree order
+        roots, self.placed = self.placed.values(), {}
+        gone = []
+        for root in roots: # with the children as they are now
+            gone.append(root)
+            gone.extend(node for node, level in outline.walk(root))
+        nodes = dict((node.id, node) for node in gone if outline.nodes.get(node.id) is node)
+        if len(gone) + len(nodes) > len(self.block_of) // 4: # many, eg pasted: build anew
+            self.build(outline)
+            return
+        changed = {} # id() -> ids of the blocks with rows taken out or put in
+        for node in gone:
+            ids = self.block_of.pop(node.id, None)
+            if ids is not None:
+                ids.remove(node.id)
+                changed[id(ids)] = ids
+        for node in sorted(nodes.values(), key=lambda node: outline.path(node.id)): # those before placed first
+            before = outline.previous(node)
+            if before is None:
+                ids, index = self.ids[0], 0
+            elif before.id not in self.block_of:
+                self.build(outline)
+                return
+            else:
+                ids = self.block_of[before.id]
+                index = ids.index(before.id) + 1
+            ids.insert(index, node.id)
+            self.block_of[node.id] = ids
+            changed[id(ids)] = ids
+        for number in sorted((self.numbers[key] for key in changed), reverse=True): # later block numbers first
+            ids = self.ids[number]
+            if len(ids) > 2 * SEARCH_BLOCK: # split into blocks of SEARCH_BLOCK rows
+                rest = ids[SEARCH_BLOCK:]
+                del ids[SEARCH_BLOCK:]
+                for start in reversed(xrange(0, len(rest), SEARCH_BLOCK)):
+                    self.add_block(number + 1, [outline.nodes[node_id] for node_id in rest[start:start + SEARCH_BLOCK]])
+            for node_id in ids: # texts as they are now
+                self.pending.pop(node_id, None)
+            self.fill(number, [outline.nodes[node_id] for node_id in ids])
+        self.count()
+        self.version += 1
+
+
+    def flush(self, outline): # put placed nodes and pending rows into their blocks
+        if self.placed:
+            self.place(outline)
+        if self.pending:
+            self.version += 1
+        for node_id, node in self.pending.items():
+            ids = self.block_of.get(node_id)
+            if ids is None: # deleted
+                continue
+            number, index = self.numbers[id(ids)], ids.index(node_id)
+            block, starts = self.blocks[number], self.starts[number]
+            start = starts[index]
+            end = starts[index + 1] if index + 1 < len(starts) else len(block)
+            if node.body is not self.spans.get(node_id): # edited text, no longer searched in the map
+                self.spans.pop(node_id, None)
+                text = self.row_text(node.title, node.desc)
+            else:
+                text = self.row_text(node.title, '')
+            self.blocks[number] = block[:start] + text + block[end:]
+            shift = len(text) - (end - start)
+            for i in xrange(index + 1, len(starts)):
+                starts[i] += shift
+        self.pending = {}
+
+
+    def prepare(self, outline): # make blocks current before searching
+        if not self.valid:
+            self.build(outline)
+        self.flush(outline)
+
+
+    def find(self, find_text, outline): # ids of nodes containing find_text (lowered)
+        self.prepare(outline)
+        ids = []
+        for number in xrange(len(self.blocks)):
+            ids.extend(self.row_id(row) for row in self.find_in_block(find_text, number))
+        return ids
+
+
+    def find_in_block(self, find_text, number): # rows of block number containing find_text
+        starts = self.starts[number]
+        first = self.firsts[number]
+        if find_text == '':
+            return range(first, first + len(starts))
+        if '\0' in find_text: # not in Gtk strings
+            return []
+        block = self.blocks[number]
+        rows = []
+        position = block.find(find_text)
+        while position != -1:
+            index = bisect.bisect_right(starts, position) - 1
+            rows.append(first + index)
+            if index + 1 == len(starts):
+                break
+            position = block.find(find_text, starts[index + 1]) # next row
+        if self.runs[number]:
+            found = set(rows)
+            ids = self.ids[number]
+            for run in self.runs[number]:
+                found.update(first + index for index in self.find_mapped(find_text, run) if ids[index] in self.spans)
+            rows = sorted(found)
+        return rows
+
+
+    def find_mapped(self, find_text, run): # indexes of run whose text in the map contains find_text
+        mapped, starts, ends, rows = run
+        found = []
+        offset = starts[0]
+        while offset < ends[-1]:
+            index = bisect.bisect_right(starts, offset) - 1
+            if offset >= ends[index]: # between texts, eg at a heading
+                offset = starts[index + 1]
+            end = min(offset + SCAN_BLOCK, ends[-1])
+            block = mapped.map[offset:min(end + len(find_text) - 1, ends[-1])].lower() # overlap for a match across
+            start, offset = offset, end
+            position = block.find(find_text)
+            while position != -1 and start + position < end:
+                index = bisect.bisect_right(starts, start + position) - 1
+                if start + position + len(find_text) > ends[index]: # runs into the heading after the text
+                    position = block.find(find_text, position + 1)
+                    continue
+                found.append(rows[index])
+                if index + 1 == len(starts):
+                    return found
+                if starts[index + 1] >= end: # next text in a later block
+                    offset = starts[index + 1]
+                    break
+                position = block.find(find_text, starts[index + 1] - start)
+        return found
+
+
+    def row_contains(self, row, find_text):
+        number, index = self.block_number(row)
+        starts = self.starts[number]
+        end = starts[index + 1] if index + 1 < len(starts) else len(self.blocks[number])
+        if find_text in self.blocks[number][starts[index]:end]:
+            return True
+        span = self.spans.get(self.ids[number][index])
+        return span is not None and bool(self.find_mapped(find_text, (span[0], [span[1]], [span[2]], [index])))
+
 
 
 
@@ -1004,51 +3336,96 @@ class Finder(list): # search in tree and texts
         self.max = 0
         self.index = 0
         self.mode = False
-
-
-    def find(self, find_text, treestore): # search treestore
-        self.mode = True
-        self.find_text = find_text.lower()
-        rootiter = treestore.get_iter_first()
-        self.recurse_find(treestore, rootiter)
-        self.max = len(self) # number of found items
+        self.search_index = SearchIndex() # observes the outline, survives reset
+        self.rows = [] # index rows of the found items
+        self.candidates = [] # rows still to check, before the remaining blocks
+        self.position = 0 # next of candidates
+        self.block = 0 # next block of search_index to scan
+        self.version = None # search_index.version the search started with
+        self.done = True # search complete
+
+
+    def find(self, find_text, outline): # search outline, collect node ids
+        self.start(find_text, outline)
+        self.scan()
         if self: return True # something found
         else: return False # nothing found
 
 
-    def recurse_find(self, treestore, iter): # recurse over treestore
-        while iter != None:
-            name, desc = treestore[iter]
-
-            name_lower = name.lower()
-            desc_lower = desc.lower()
+    def start(self, find_text, outline): # begin a search carried out by scan()
+        find_text = find_text.lower()
+        index = self.search_index
+        index.prepare(outline)
+        candidates = []
+        block = 0
+        if self.mode and self.find_text and self.find_text in find_text and self.version == index.version:
+            # longer find text: only the items found so far and the unsearched rest can match
+            candidates = self.rows + self.candidates[self.position:]
+            block = self.block
+        self.reset()
+        self.mode = True
+        self.find_text = find_text
+        self.candidates = candidates
+        self.block = block
+        self.version = index.version
+        self.done = False
+
+
+    def scan(self, seconds=None, wanted=None): # continue search for some seconds, to wanted results or to the end; True if done
+        index = self.search_index
+        deadline = None
+        if seconds is not None:
+            deadline = time.time() + seconds
+        while self.position < len(self.candidates):
+            if deadline is not None and time.time() > deadline or wanted is not None and len(self) >= wanted:
+                return False
+            row = self.candidates[self.position]
+            self.position += 1
+            if index.row_contains(row, self.find_text):
+                self.add(row)
+        while self.block < len(index.blocks):
+            if deadline is not None and time.time() > deadline or wanted is not None and len(self) >= wanted:
+                return False
+            for row in index.find_in_block(self.find_text, self.block):
+                self.add(row)
+            self.block += 1
+        self.done = True
+        return True
+
+
+    def add(self, row):
+        self.rows.append(row)
+        self.append(self.search_index.row_id(row))
+        self.max = len(self) # number of found items
 
-            if self.find_text in name_lower or self.find_text in desc_lower:
-                self.append(iter)
 
-            if treestore.iter_has_child(iter):
-                childiter = treestore.iter_children(iter)
-                self.recurse_find(treestore, childiter)
-            iter = treestore.iter_next(iter)
+    def count_text(self): # '+' while more may be found
+        return "%i/%i%s" % (self.index, self.max, '' if self.done else '+')
 
 
-    def get_next(self, find_count): # get next search result
-        if self.index == self.max:
+    def get_next(self, find_count): # get next search result, searching only as far as needed; None if none
+        if self.index >= self.max and not self.done:
+            self.scan(wanted=self.index + 1)
+        if not self:
+            return None
+        if self.index >= self.max:
             self.index = 0 # start from beginning
         result = self[self.index]
         self.index += 1 # next one
-        count = ("%i/%i" % (self.index, self.max))
-        find_count.set_text(count)
+        find_count.set_text(self.count_text())
         return result
 
 
-    def get_previous(self, find_count): # get previous search result
-        if self.index == 1:
+    def get_previous(self, find_count): # get previous search result; None if none
+        if self.index <= 1 and not self.done:
+            self.scan() # the last one is needed
+        if not self:
+            return None
+        if self.index <= 1:
             self.index = self.max + 1 # start from end
         self.index -= 1 # previous one
         result = self[self.index-1]
-        count = ("%i/%i" % (self.index, self.max))
-        find_count.set_text(count)
+        find_count.set_text(self.count_text())
         return result
 
 
@@ -1058,57 +3435,405 @@ class Finder(list): # search in tree and texts
         self.max = 0
         self.index = 0
         self.mode = False
+        self.rows = []
+        self.candidates = []
+        self.position = 0
+        self.block = 0
+        self.done = True
 
 
-class Undo:
+class Undo: # text deltas per node, undo steps of all nodes share one memory budget
 
-    def __init__(self):
-        self.stack = [] # list of undoables
+    INSERT = 0
+    DELETE = 1
+
+    def __init__(self, budget=UNDO_BUDGET):
         self.textbuffer = None
         self.textview = None
-        self.freeze = False # prevent unwanted undo.add when undo.back called
-        self.pointer = 0 # stack position
+        self.freeze = False # prevent recording while undo/redo changes the text
+        self.budget = budget # bytes, see UNDO_BUDGET
+        self.used = 0 # bytes held by all steps
+        self.histories = [] # [node id, undo steps, redo steps], least recently used first
+        self.history = None # history of the node in textbuffer
+        self.action = 0 # nesting depth of buffer user actions
+        self.step = None # step collecting the deltas of the ongoing user action
+        self.typing = False # next single char may extend the last step
+
+
+    def attach(self, textbuffer, textview):
+        self.textbuffer = textbuffer
+        self.textview = textview
+
+
+    def select(self, node_id, nodes): # switch to the history of node_id, nodes: ids in the outline
+        self.step = None
+        self.typing = False
+        found = None
+        histories = []
+        for history in self.histories:
+            if history[0] not in nodes: # node deleted
+                self.forget(history[1] + history[2])
+            elif found is None and history[0] == node_id:
+                found = history
+            elif history[1] or history[2]:
+                histories.append(history)
+        if found is None:
+            found = [node_id, [], []]
+        histories.append(found) # most recently used
+        self.histories = histories
+        self.history = found
+
+
+    def remap(self, ids, changed): # node ids renumbered (old -> new, None: kept), changed: nodes whose text was replaced
+        histories = []
+        for history in self.histories:
+            if history[0] not in changed and (ids is None or history[0] in ids):
+                if ids is not None:
+                    history[0] = ids[history[0]]
+                histories.append(history)
+            else: # steps do not fit the text anymore
+                self.forget(history[1] + history[2])
+        self.histories = histories
+        self.history = None # until select
+        self.step = None
+
+
+    def begin_action(self):
+        if not self.freeze:
+            self.action += 1
 
 
-    def add(self, textbuffer, textview, content): # add undo content
-        if not self.freeze:
-            self.textbuffer = textbuffer
-            self.textview = textview
-            iter = textbuffer.get_iter_at_mark(textbuffer.get_insert()) # current position
-            if iter != None:
-                position = iter.get_offset() # get current position of iter as int
-                self.stack.append([content, position])
-                self.pointer = len(self.stack) - 1 # last element in stack
+    def end_action(self):
+        if not self.freeze and self.action > 0:
+            self.action -= 1
+            if self.action == 0:
+                self.step = None
+
+
+    def insert(self, offset, text, cursor): # text (str) inserted at char offset
+        self.record(self.INSERT, offset, text.decode('utf-8'), cursor)
+
+
+    def delete(self, offset, text, cursor): # text (str) deleted from char offset
+        self.record(self.DELETE, offset, text.decode('utf-8'), cursor)
+
+
+    def record(self, kind, offset, text, cursor):
+        if self.freeze or self.history is None:
+            return
+        undos, redos = self.history[1], self.history[2]
+        size = len(text) + UNDO_DELTA_SIZE
+        if redos: # new edit ends the redo chain
+            self.forget(redos)
+            del redos[:]
+
+        if self.step is not None: # more deltas of the same user action
+            self.step[2].append((kind, offset, text))
+            self.step[1] += size
+        elif self.typing and undos and self.extend(undos[-1], kind, offset, text):
+            undos[-1][1] += len(text)
+            size = len(text)
+            if self.action:
+                self.step = undos[-1]
+        else:
+            step = [cursor, size, [(kind, offset, text)]] # cursor before, bytes, deltas
+            undos.append(step)
+            if self.action:
+                self.step = step
+        self.used += size
+        self.typing = len(text) == 1
+        self.evict()
+
+
+    def extend(self, step, kind, offset, text): # merge typed char into step, True if done
+        if len(step[2]) != 1 or len(text) != 1 or text == '\n':
+            return False
+        last_kind, last_offset, last_text = step[2][0]
+        if kind != last_kind:
+            return False
+        if kind == self.INSERT:
+            if offset != last_offset + len(last_text) or last_text[-1] == '\n':
+                return False
+            if text.isspace() and not last_text[-1].isspace(): # one step per word
+                return False
+            step[2][0] = (kind, last_offset, last_text + text)
+        elif offset + 1 == last_offset: # backspace
+            step[2][0] = (kind, offset, text + last_text)
+        elif offset == last_offset: # delete key
+            step[2][0] = (kind, offset, last_text + text)
+        else:
+            return False
+        return True
+
+
+    def forget(self, steps):
+        for step in steps:
+            self.used -= step[1]
+            if step is self.step:
+                self.step = None
+
+
+    def evict(self): # drop oldest steps, least recently used nodes first
+        while self.used > self.budget:
+            for history in self.histories:
+                if history[2]:
+                    self.forget([history[2].pop(0)]) # farthest redo
+                    break
+                if history[1]:
+                    self.forget([history[1].pop(0)]) # oldest undo
+                    break
+            else:
+                break
 
 
     def undo(self, mode): # mode = 'undo' or 'redo'
-        self.freeze = True
+        if self.history is None:
+            return
         if mode == 'undo':
-            if self.pointer > 0: self.pointer -= 1
+            source, target = self.history[1], self.history[2]
         else:     # redo
-            if self.pointer < len(self.stack) - 1: self.pointer += 1
+            source, target = self.history[2], self.history[1]
+        if not source:
+            return
+        step = source.pop()
+        target.append(step)
 
-        content = self.stack[self.pointer][0] # get the text
-        position = self.stack[self.pointer][1] # get the cursor position
-        self.textbuffer.set_text(content) # set the text
-        iter = self.textbuffer.get_iter_at_offset(position) # get iter from cursor position
-        if iter != None:
+        self.freeze = True
+        self.typing = False
+        try:
+            deltas = step[2]
+            if mode == 'undo':
+                deltas = reversed(deltas)
+            for kind, offset, text in deltas:
+                start = self.textbuffer.get_iter_at_offset(offset)
+                if (kind == self.INSERT) == (mode == 'undo'): # remove text
+                    end = self.textbuffer.get_iter_at_offset(offset + len(text))
+                    self.textbuffer.delete(start, end)
+                    position = offset
+                else: # put text back
+                    self.textbuffer.insert(start, text.encode('utf-8'))
+                    position = offset + len(text)
+            if mode == 'undo':
+                position = step[0] # cursor as before the step
+            iter = self.textbuffer.get_iter_at_offset(position) # get iter from cursor position
             self.textbuffer.place_cursor(iter) # set the cursor
             mark = self.textbuffer.get_mark('insert') # get mark at cursor
             self.textview.scroll_to_mark(mark, 0, False, 0, 0) # scroll to cursor
+        finally:
             self.freeze = False
 
 
-    def clear(self): # reset undo stack
-        self.stack = []
+    def clear(self): # drop all histories
+        self.histories = []
+        self.history = None
+        self.step = None
+        self.used = 0
+
+
+
+
+def find_node(outline, path):
+    '''node at a tree path like '0:2:1' or at titles like 'Top > Sub' (see SEPB), None if not found'''
+    node = outline.root
+    if re.match(r'^\d+(:\d+)*$', path):
+        for position in path.split(':'):
+            if int(position) >= len(node.children):
+                return None
+            node = node.children[int(position)]
+        return node
+    for title in path.split(SEPB.strip()):
+        for child in node.children:
+            if child.title == title.strip():
+                node = child
+                break
+        else:
+            return None
+    return node
+
+
+def load_notes(args):
+    '''(persistence, outline) of the notes file of the command line, default the one of the gui'''
+    persistence = Persistence()
+    filename = args.file or persistence.setting['filename']
+    if file_stamp(filename) is None:
+        raise CommandError('no notes file %s' % filename)
+    outline = persistence.load(Outline(), filename, remember=False, journal=False) # gui keeps its file and journal
+    return persistence, outline
+
+
+class CommandError(Exception): # reported by run_command, exit status 2
+    pass
+
+
+def command_export_html(args):
+    persistence, outline = load_notes(args)
+    success, filename = persistence.store_html(outline, args.output)
+    if not success:
+        raise CommandError('export to %s failed' % args.output)
+    report = persistence.export_report
+    print '%s: %i sections, %i rendered, %.2f s' % (filename, report['sections'], report['rendered'], report['seconds'])
+    return 0
+
+
+def command_export_site(args):
+    persistence, outline = load_notes(args)
+    if not os.path.isdir(args.folder):
+        os.makedirs(args.folder)
+    success, filename = persistence.store_site(outline, args.folder, args.processes)
+    if not success:
+        raise CommandError('export to %s failed' % args.folder)
+    report = persistence.export_report
+    print '%s: %i of %i pages written, %i removed, %.0f pages/s with %i processes' % (filename, report['written'],
+        report['pages'], report['removed'], report['pages_per_second'], report['processes'])
+    return 0
+
+
+def command_search(args):
+    persistence, outline = load_notes(args)
+    finder = Finder()
+    if not finder.find(args.text, outline):
+        return 1 # like grep
+    for node_id in finder:
+        print SEPB.join(outline.titles(node_id))
+    return 0
+
+
+def command_stats(args):
+    persistence, outline = load_notes(args)
+    depth = words = text = 0
+    for node, level in outline.walk():
+        depth = max(depth, level)
+        desc = node.desc
+        text += len(node.title) + len(desc)
+        words += len(node.title.split()) + len(desc.split())
+    print 'file: %s' % persistence.setting['filename']
+    print 'bytes: %i' % file_stamp(persistence.setting['filename'])[0]
+    if persistence.workspace is not None:
+        print 'files: %i' % len(persistence.workspace.files)
+    print 'nodes: %i' % len(outline.nodes)
+    print 'top level nodes: %i' % len(outline.root.children)
+    print 'depth: %i' % depth
+    print 'text bytes: %i' % text
+    print 'words: %i' % words
+    print 'unsaved edits: %s' % ('yes' if os.path.exists(persistence.setting['filename'] + JOURNAL_SUFFIX) else 'no')
+    return 0
+
+
+def command_cat(args):
+    persistence, outline = load_notes(args)
+    node = find_node(outline, args.path)
+    if node is None:
+        raise CommandError('no node %s' % args.path)
+    top = len(outline.path(node.id))
+    sys.stdout.write(section_markdown(node.title, node.desc, top))
+    for child, level in outline.walk(node):
+        sys.stdout.write(section_markdown(child.title, child.desc, top + level))
+    return 0
 
 
+def command_convert(args):
+    persistence, outline = load_notes(args)
+    if os.path.exists(args.output):
+        raise CommandError('%s exists' % args.output)
+    if is_database(args.output):
+        Database(args.output).save(outline)
+    else:
+        with open(args.output + '.tmp', 'wb') as fh:
+            for chunk in persistence.iter_markdown():
+                fh.write(chunk)
+        os.rename(args.output + '.tmp', args.output)
+    print '%s: %i nodes' % (args.output, len(outline.nodes))
+    return 0
+
+
+def command_check(args):
+    '''errors make the file unusable, warnings mean a save rewrites parts of it'''
+    filename = args.file or Persistence().setting['filename']
+    if is_database(filename): # rows are saved as they are, only a journal is worth a warning
+        persistence, outline = load_notes(args)
+        journal = os.path.exists(filename + JOURNAL_SUFFIX)
+        if journal:
+            print 'warning: unsaved edits of a crashed session in %s' % (filename + JOURNAL_SUFFIX)
+        print '%s: %i nodes, %i warnings' % (filename, len(outline.nodes), journal)
+        return 0
+    try:
+        with open(filename, 'rb') as fh:
+            data = fh.read()
+        check_utf8(data)
+    except IOError, e:
+        print 'error: %s' % e
+        return 1
+    except UnicodeDecodeError, e:
+        print 'error: %s is not utf-8: %s' % (filename, e)
+        return 1
+    journal = os.path.exists(filename + JOURNAL_SUFFIX)
+    persistence, outline = load_notes(args)
+    warnings = 0
+    if journal:
+        print 'warning: unsaved edits of a crashed session in %s' % (filename + JOURNAL_SUFFIX)
+        warnings += 1
+    if has_odd_eol(data):
+        print 'warning: line ends other than \\n and \\r\\n'
+        warnings += 1
+    text = persistence.as_markdown()
+    if not journal and text != data:
+        same = 0 # bytes before the first difference
+        while text[same:same + COPY_BLOCK] == data[same:same + COPY_BLOCK]:
+            same += COPY_BLOCK
+        while same < min(len(text), len(data)) and text[same] == data[same]:
+            same += 1
+        print 'warning: saving rewrites the file from line %i' % (data.count('\n', 0, same) + 1)
+        warnings += 1
+    print '%s: %i nodes, %i warnings' % (filename, len(outline.nodes), warnings)
+    return 0
 
 
-def main():
+COMMANDS = [ # name, function, help, arguments
+    ('export-html', command_export_html, 'export the notes as one HTML file', [('output', {})]),
+    ('export-site', command_export_site, 'export one HTML page per node',
+        [('folder', {}), ('--processes', {'type': int, 'help': 'default one per core'})]),
+    ('search', command_search, 'print the nodes containing text, exit status 1 if none', [('text', {})]),
+    ('stats', command_stats, 'print size and shape of the notes', []),
+    ('cat', command_cat, 'print a node with its children as markdown',
+        [('path', {'help': "titles like 'Top > Sub' or a tree path like 0:2:1"})]),
+    ('convert', command_convert, 'write the notes to a new sqlite database (.db) or markdown file',
+        [('output', {})]),
+    ('check', command_check, 'check that the notes file loads and saves unchanged', []),
+]
+
+
+def run_command(argv):
+    '''run a command without display, see COMMANDS; exit status'''
+    import argparse
+    parser = argparse.ArgumentParser(prog=PROGRAM_NAME, description='%s %s, without arguments the gui starts' % (
+        PROGRAM_NAME, VERSION))
+    parser.add_argument('-f', '--file', help='notes file or workspace folder, default the last one opened in the gui')
+    commands = parser.add_subparsers(title='commands')
+    for name, function, text, arguments in COMMANDS:
+        command = commands.add_parser(name, help=text, description=text)
+        for argument, options in arguments:
+            command.add_argument(argument, **options)
+        command.set_defaults(function=function)
+    args = parser.parse_args(argv)
+    try:
+        return args.function(args)
+    except CommandError, e:
+        sys.stderr.write('%s: %s\n' % (PROGRAM_NAME, e))
+        return 2
+    except IOError, e:
+        if e.errno != errno.EPIPE: # output piped to eg head, which has enough
+            raise
+        return 0
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv: # a command, no display needed
+        return run_command(argv)
     gui = Gui()
     Gtk.main()
     return 0
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,539 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ilunote - tests
+#
+# Copyright (C) 2013 github.com/dayf/ilunote
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# run `python -m unittest test_ilunote` in this folder; needs no display,
+# the text view handlers of the Gui run against TextBuffer below.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import ilunote
+
+
+class GLib(object): # timeouts that never fire
+    def timeout_add(self, ms, callback):
+        return 1
+
+    def source_remove(self, source):
+        pass
+
+
+class TextIter(object):
+    def __init__(self, buffer, offset):
+        self.buffer = buffer
+        self.offset = offset
+
+    def get_offset(self):
+        return self.offset
+
+    def get_line(self):
+        return self.buffer.text[:self.offset].count(u'\n')
+
+    def copy(self):
+        return TextIter(self.buffer, self.offset)
+
+    def backward_chars(self, count):
+        self.offset = max(self.offset - count, 0)
+
+
+class TextView(object):
+    def scroll_to_mark(self, *args):
+        pass
+
+
+class TextBuffer(object): # the signals of a GtkTextBuffer, sent to the Gui handlers
+    def __init__(self, gui, text=''):
+        self.gui = gui
+        self.text = text.decode('utf-8')
+        self.cursor = len(self.text)
+
+    def get_iter_at_offset(self, offset):
+        return TextIter(self, max(0, min(offset, len(self.text))))
+
+    def get_iter_at_line(self, line):
+        offset = 0
+        for count in range(line):
+            offset = self.text.index(u'\n', offset) + 1
+        return TextIter(self, offset)
+
+    def get_insert(self):
+        return 'insert'
+
+    def get_mark(self, name):
+        return name
+
+    def get_iter_at_mark(self, mark):
+        return TextIter(self, self.cursor)
+
+    def place_cursor(self, iter):
+        self.cursor = iter.offset
+
+    def get_text(self, start, end, hidden):
+        return self.text[start.offset:end.offset].encode('utf-8')
+
+    def begin_user_action(self):
+        self.gui.on_textbuffer_begin_user_action(self)
+
+    def end_user_action(self):
+        self.gui.on_textbuffer_end_user_action(self)
+
+    def insert(self, iter, text):
+        self.gui.on_textbuffer_insert_text(self, iter, text, len(text))
+        chars = text.decode('utf-8')
+        self.text = self.text[:iter.offset] + chars + self.text[iter.offset:]
+        iter.offset += len(chars)
+        self.cursor = iter.offset
+        self.gui.on_textbuffer_changed(self)
+
+    def delete(self, start, end):
+        self.gui.on_textbuffer_delete_range(self, start, end)
+        self.text = self.text[:start.offset] + self.text[end.offset:]
+        self.cursor = start.offset
+        end.offset = start.offset
+        self.gui.on_textbuffer_changed(self)
+
+    def type(self, key, text): # a keystroke at the cursor
+        self.gui.keyname = key
+        self.begin_user_action()
+        self.insert(self.get_iter_at_offset(self.cursor), text)
+        self.end_user_action()
+
+
+class Editor(object): # the text view part of the Gui
+    def __init__(self, text):
+        for name in ('on_textbuffer_insert_text', 'on_textbuffer_delete_range', 'on_textbuffer_begin_user_action',
+                'on_textbuffer_end_user_action', 'on_textbuffer_changed', 'replace_text', 'cancel_highlight',
+                'on_text_sync', '_cursor_offset'):
+            setattr(self, name, ilunote.Gui.__dict__[name].__get__(self))
+        self.textbuffer = TextBuffer(self, text)
+        self.undo = ilunote.Undo()
+        self.undo.attach(self.textbuffer, TextView())
+        self.undo.select(0, [0])
+        self.text_node = 0
+        self.text_deltas = []
+        self.textbuffer_loading = False
+        self.text_sync = None
+        self.indent_pending = False
+        self.highlight_spans = []
+        self.highlight_source = None
+        self.keyname = None
+
+    def text(self):
+        return self.textbuffer.text.encode('utf-8')
+
+    def undo_all(self):
+        while self.undo.history[1]:
+            self.undo.undo('undo')
+
+    def redo_all(self):
+        while self.undo.history[2]:
+            self.undo.undo('redo')
+
+
+class IndentLinesTest(unittest.TestCase):
+
+    def test_indent(self):
+        self.assertEqual(ilunote.indent_lines('a'), '\ta')
+        self.assertEqual(ilunote.indent_lines('a\n\tb\n'), '\ta\n\t\tb\n\t')
+        self.assertEqual(ilunote.indent_lines(''), '\t')
+
+    def test_unindent(self):
+        self.assertEqual(ilunote.unindent_lines('\ta\n\t\tb'), 'a\n\tb')
+        self.assertEqual(ilunote.unindent_lines('a\n\tb\n c'), 'a\nb\n c') # lines without a tab stay
+        self.assertEqual(ilunote.unindent_lines('a\nb'), 'a\nb')
+        self.assertEqual(ilunote.unindent_lines(''), '')
+
+    def test_round_trip(self):
+        for text in ('a', 'a\nb', '\ta\n\n\t\tb\n', '* a\n\t* b', '\n\n', '\xc3\xa4\n\t\xc3\xb6'):
+            self.assertEqual(ilunote.unindent_lines(ilunote.indent_lines(text)), text)
+            self.assertEqual(ilunote.unindent_lines(ilunote.unindent_lines(ilunote.indent_lines(
+                ilunote.indent_lines(text)))), text)
+
+
+class OddEolTest(unittest.TestCase): # line ends scanned in blocks of SCAN_BLOCK bytes
+
+    def setUp(self):
+        self.scan_block, ilunote.SCAN_BLOCK = ilunote.SCAN_BLOCK, 8
+
+    def tearDown(self):
+        ilunote.SCAN_BLOCK = self.scan_block
+
+    def test_crlf_across_blocks(self):
+        for length in range(30): # '\r' and '\n' in the same block, apart, in the overlap and past it
+            self.assertFalse(ilunote.has_odd_eol('x' * length + '\r\nabc\r\n' + 'y' * 20), length)
+
+    def test_odd(self):
+        for length in range(30):
+            self.assertTrue(ilunote.has_odd_eol('x' * length + '\rabc' + 'y' * 20), length)
+            self.assertTrue(ilunote.has_odd_eol('x' * length + '\r'), length) # the last byte
+            self.assertTrue(ilunote.has_odd_eol('x' * length + '\xe2\x80\xa8' + 'y' * 20), length)
+
+
+class AutoIndentTest(unittest.TestCase): # before: text from two lines above to the cursor
+
+    def test_tab_continued(self):
+        self.assertEqual(ilunote.auto_indent('\tfoo\n', 'Return'), (0, '\t'))
+        self.assertEqual(ilunote.auto_indent('a\n\t\tfoo\n', 'KP_Enter'), (0, '\t\t'))
+
+    def test_no_tab(self):
+        self.assertEqual(ilunote.auto_indent('foo\n', 'Return'), None)
+        self.assertEqual(ilunote.auto_indent('\tfoo\nbar\n', 'Return'), None) # only the line before counts
+        self.assertEqual(ilunote.auto_indent('\tfoo', 'o'), None)
+        self.assertEqual(ilunote.auto_indent('', 'x'), None)
+
+    def test_tabs_only(self): # a second Return ends the indentation
+        self.assertEqual(ilunote.auto_indent('\tfoo\n\t\n', 'Return'), (2, '\n'))
+
+    def test_bullet_continued(self):
+        self.assertEqual(ilunote.auto_indent('* item\n', 'Return'), (0, '* '))
+        self.assertEqual(ilunote.auto_indent('* a\n\t* item\n', 'Return'), (0, '\t* '))
+
+    def test_empty_bullet_removed(self): # Return on a bullet without text ends the list
+        self.assertEqual(ilunote.auto_indent('* item\n* \n', 'Return'), (4, '\n\n'))
+        self.assertEqual(ilunote.auto_indent('* \n', 'Return'), (3, '\n\n'))
+
+    def test_deleting_a_line_end(self):
+        self.assertEqual(ilunote.auto_indent('\tfoo\n', 'BackSpace'), None)
+        self.assertEqual(ilunote.auto_indent('* item\n', 'Delete'), None)
+
+    def test_bullet_indented(self):
+        self.assertEqual(ilunote.auto_indent('* \t', 'Tab'), (3, '\t* '))
+        self.assertEqual(ilunote.auto_indent('* item\t', 'Tab'), None)
+
+    def test_bullet_outdented(self):
+        self.assertEqual(ilunote.auto_indent('\t*', 'BackSpace'), (2, '* '))
+        self.assertEqual(ilunote.auto_indent('*', 'BackSpace'), None)
+
+
+class UndoAutoIndentTest(unittest.TestCase): # undo and redo replay deltas without indenting again
+
+    def setUp(self):
+        self.glib, ilunote.GLib = ilunote.GLib, GLib()
+
+    def tearDown(self):
+        ilunote.GLib = self.glib
+
+    def test_return_after_indented_line(self):
+        editor = Editor('\tfoo')
+        editor.textbuffer.type('Return', '\n')
+        self.assertEqual(editor.text(), '\tfoo\n\t')
+        editor.undo_all()
+        self.assertEqual(editor.text(), '\tfoo')
+        editor.redo_all()
+        self.assertEqual(editor.text(), '\tfoo\n\t')
+
+    def test_bullet_continued(self):
+        editor = Editor('* item')
+        editor.textbuffer.type('Return', '\n')
+        editor.textbuffer.type('x', 'x')
+        self.assertEqual(editor.text(), '* item\n* x')
+        editor.undo_all()
+        self.assertEqual(editor.text(), '* item')
+        editor.redo_all()
+        self.assertEqual(editor.text(), '* item\n* x')
+
+    def test_empty_bullet_removed(self):
+        editor = Editor('* item\n* ')
+        editor.textbuffer.type('Return', '\n')
+        self.assertEqual(editor.text(), '* item\n\n')
+        editor.undo_all()
+        self.assertEqual(editor.text(), '* item\n* ')
+        editor.redo_all()
+        self.assertEqual(editor.text(), '* item\n\n')
+
+    def test_bullet_indented(self):
+        editor = Editor('* ')
+        editor.textbuffer.type('Tab', '\t')
+        self.assertEqual(editor.text(), '\t* ')
+        editor.undo_all()
+        self.assertEqual(editor.text(), '* ')
+
+    def test_one_step_per_key(self): # the key and its indent are undone together
+        editor = Editor('\tfoo')
+        editor.textbuffer.type('Return', '\n')
+        editor.textbuffer.type('Return', '\n')
+        self.assertEqual(editor.text(), '\tfoo\n\n')
+        editor.undo.undo('undo')
+        self.assertEqual(editor.text(), '\tfoo\n\t')
+        editor.undo.undo('undo')
+        self.assertEqual(editor.text(), '\tfoo')
+
+
+class UndoBudgetTest(unittest.TestCase): # the undo steps of all nodes share one budget, the oldest go first
+
+    def setUp(self):
+        self.glib, ilunote.GLib = ilunote.GLib, GLib()
+
+    def tearDown(self):
+        ilunote.GLib = self.glib
+
+    def type_words(self, editor, node_id, count): # ' w00 w01 ...', a step per word
+        editor.undo.select(node_id, [0, 1, 2])
+        for word in range(count):
+            for char in ' w%02i' % word:
+                editor.textbuffer.type(char, char)
+                self.assertTrue(editor.undo.used <= editor.undo.budget)
+
+    def steps(self, editor): # node id -> texts of its undo steps, oldest first
+        return dict((history[0], [step[2][0][2] for step in history[1]]) for history in editor.undo.histories)
+
+    def test_budget(self):
+        editor = Editor('')
+        editor.undo.budget = 18 * (len(' w00') + ilunote.UNDO_DELTA_SIZE) # the steps of the last node and 3 more
+        for node_id in (0, 1, 2):
+            self.type_words(editor, node_id, 15)
+        self.assertEqual(editor.undo.used, sum(step[1] for history in editor.undo.histories for step in history[1]))
+        steps = self.steps(editor)
+        self.assertEqual(steps.get(0, []), []) # least recently used node first
+        self.assertEqual(steps[1], [u' w12', u' w13', u' w14']) # its newest steps kept
+        self.assertEqual(steps[2], [u' w%02i' % word for word in range(15)])
+
+    def test_sustained_typing(self): # one node, the oldest steps dropped as new ones come
+        editor = Editor('')
+        editor.undo.budget = 1000
+        self.type_words(editor, 0, 100)
+        steps = self.steps(editor)[0]
+        self.assertEqual(steps, [u' w%02i' % word for word in range(100 - len(steps), 100)])
+        self.assertTrue(editor.undo.used <= 1000 < editor.undo.used + len(' w00') + ilunote.UNDO_DELTA_SIZE)
+
+
+class MappedMergeTest(unittest.TestCase): # notes another program wrote while their file was mapped
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.saved = ilunote.JSETFP, ilunote.LAZY_LOAD_SIZE
+        ilunote.JSETFP = os.path.join(self.folder, 'settings.json')
+        ilunote.LAZY_LOAD_SIZE = 1 # every file mapped
+        self.filename = os.path.join(self.folder, 'notes.text')
+        self.write(''.join('# heading %i\n%s\n\n' % (number, 'text ' * 200) for number in range(50)))
+        self.persistence = ilunote.Persistence()
+        self.outline = ilunote.Outline()
+        self.outline.observers.append(self.persistence.on_outline_changed)
+        self.persistence.load(self.outline, self.filename, remember=False)
+        self.assertNotEqual(self.persistence.mapped, None)
+
+    def tearDown(self):
+        self.persistence.journal.stop()
+        ilunote.JSETFP, ilunote.LAZY_LOAD_SIZE = self.saved
+        shutil.rmtree(self.folder)
+
+    def write(self, text, name=None):
+        with open(name or self.filename, 'wb') as fh:
+            fh.write(text)
+        os.utime(name or self.filename, (2e9, 2e9)) # other than when loaded
+
+    def titles(self):
+        return [node.title for node, level in self.outline.walk()]
+
+    def test_truncated(self): # the old texts are past the end of the file, reading them was a bus error
+        self.write('# new\nshort\n')
+        self.assertTrue(self.persistence.changed_on_disk())
+        self.assertEqual(self.persistence.merge(self.outline), None) # load again
+        self.assertRaises(ValueError, lambda: self.outline.root.children[-1].desc)
+        self.persistence.load(self.outline, self.filename, remember=False)
+        self.assertEqual(self.titles(), [ilunote.BLANK_NODE, 'new'])
+        self.assertEqual(self.outline.root.children[-1].desc, 'short\n')
+
+    def test_renamed_over(self): # the map keeps the old file, unchanged sections keep their nodes
+        with open(self.filename, 'rb') as fh:
+            text = fh.read()
+        node = self.outline.root.children[-1]
+        self.write(text.replace('# heading 3\n', '# heading 3\nnew\n'), self.filename + '.new')
+        os.rename(self.filename + '.new', self.filename)
+        self.assertTrue(self.persistence.changed_on_disk())
+        ids, changed = self.persistence.merge(self.outline)
+        self.assertTrue(self.outline.nodes[ids[node.id]] is node)
+        self.assertEqual(len(changed), 1)
+        self.assertEqual(self.titles(), [ilunote.BLANK_NODE] + ['heading %i' % number for number in range(50)])
+
+    def test_unreadable(self): # nothing merged, the unsaved edits stay in the journal
+        self.outline.set_title(self.outline.root.children[-1].id, 'edited')
+        self.write('# not utf-8 \xff\n', self.filename + '.new')
+        os.rename(self.filename + '.new', self.filename)
+        self.assertRaises(UnicodeDecodeError, self.persistence.merge, self.outline)
+        self.assertEqual(self.titles()[-1], 'edited')
+        self.assertTrue(os.path.exists(self.filename + ilunote.JOURNAL_SUFFIX))
+        self.outline.set_title(self.outline.root.children[-1].id, 'edited again') # still recorded
+        self.persistence.journal.stop()
+        with open(self.filename + ilunote.JOURNAL_SUFFIX, 'rb') as fh:
+            self.assertTrue('edited again' in fh.read())
+
+
+class CommandLoadTest(unittest.TestCase): # commands read the notes, the journal of the gui stays
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.jsetfp = ilunote.JSETFP
+        ilunote.JSETFP = os.path.join(self.folder, 'settings.json')
+        self.filename = os.path.join(self.folder, 'notes.text')
+        with open(self.filename, 'wb') as fh:
+            fh.write('# top\ntext\n')
+
+    def tearDown(self):
+        ilunote.JSETFP = self.jsetfp
+        shutil.rmtree(self.folder)
+
+    def journal(self, text=None): # write it, or read it
+        with open(self.filename + ilunote.JOURNAL_SUFFIX, 'rb' if text is None else 'wb') as fh:
+            if text is None:
+                return fh.read()
+            fh.write(text)
+
+    def load(self):
+        class Args(object):
+            file = self.filename
+        persistence, outline = ilunote.load_notes(Args())
+        return outline
+
+    def test_other_version(self):
+        self.journal('{"base": [1, 2]}\n')
+        self.load()
+        self.assertEqual(self.journal(), '{"base": [1, 2]}\n')
+
+    def test_not_replayed(self): # edits of a crashed gui, replayed by the gui only
+        persistence = ilunote.Persistence()
+        outline = ilunote.Outline()
+        outline.observers.append(persistence.on_outline_changed)
+        persistence.load(outline, self.filename, remember=False)
+        outline.set_title(outline.root.children[-1].id, 'edited')
+        persistence.journal.stop()
+        text = self.journal() + '{"cut' # a record cut by the crash
+        self.journal(text)
+        self.assertEqual(self.load().root.children[-1].title, 'top')
+        self.assertEqual(self.journal(), text)
+
+
+class FileStampTest(unittest.TestCase): # a workspace folder changed by its notes files only
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.write('a.text')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, name, text='# a\n'):
+        with open(os.path.join(self.folder, name), 'wb') as fh:
+            fh.write(text)
+
+    def test_other_files(self):
+        stamp = ilunote.file_stamp(self.folder)
+        for name in ('.a.text.swp', '.DS_Store', 'a.text.tmp', 'a.text.backup'):
+            self.write(name)
+        os.utime(self.folder, (2e9, 2e9))
+        self.assertEqual(ilunote.file_stamp(self.folder), stamp)
+
+    def test_notes_files(self):
+        stamp = ilunote.file_stamp(self.folder)
+        self.write('b.md')
+        self.assertNotEqual(ilunote.file_stamp(self.folder), stamp)
+        os.remove(os.path.join(self.folder, 'b.md'))
+        self.assertEqual(ilunote.file_stamp(self.folder), stamp)
+        os.utime(os.path.join(self.folder, 'a.text'), (2e9, 2e9))
+        self.assertNotEqual(ilunote.file_stamp(self.folder), stamp)
+
+    def test_as_json(self): # the journal keeps it as its base
+        self.write('\xc3\xa4.text')
+        stamp = ilunote.file_stamp(self.folder)
+        self.assertEqual(json.loads(json.dumps(stamp)), stamp)
+
+
+class WorkspaceResectionTest(unittest.TestCase): # a save re-sections the files written, the folder is not loaded again
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.jsetfp = ilunote.JSETFP
+        ilunote.JSETFP = os.path.join(self.folder, 'settings.json')
+        self.notes = os.path.join(self.folder, 'notes')
+        os.mkdir(self.notes)
+        for name, text in (('a.text', '# a\ntext\n'), ('b.text', '# b\ntext\n')):
+            with open(os.path.join(self.notes, name), 'wb') as fh:
+                fh.write(text)
+
+    def tearDown(self):
+        ilunote.JSETFP = self.jsetfp
+        shutil.rmtree(self.folder)
+
+    def load(self):
+        persistence = ilunote.Persistence()
+        outline = ilunote.Outline()
+        outline.observers.append(persistence.on_outline_changed)
+        persistence.load(outline, self.notes, remember=False)
+        return persistence, outline
+
+    def tree(self, outline):
+        return [(node.title, node.desc, level) for node, level in outline.walk()]
+
+    def save(self, persistence, outline):
+        nodes = dict((node.id, node) for node, level in outline.walk())
+        persistence.save(outline)
+        self.assertEqual(persistence.resection(outline)[0], None)
+        self.assertEqual(self.tree(outline), self.tree(self.load()[1]))
+        return nodes
+
+    def test_heading_typed(self):
+        persistence, outline = self.load()
+        a = [top for top in outline.root.children if top.title == 'a.text'][0]
+        node = a.children[-1]
+        outline.set_desc(node.id, 'text\n\n## typed\nbelow\n')
+        nodes = self.save(persistence, outline)
+        self.assertIs(outline.nodes[node.id], node)
+        self.assertEqual([child.title for child in node.children], ['typed'])
+        self.assertTrue(all(outline.nodes[node_id] is nodes[node_id] for node_id in nodes))
+
+    def test_file_added(self):
+        persistence, outline = self.load()
+        top = outline.add(None, 'c.text', 'first\n', 0)
+        self.save(persistence, outline)
+        self.assertEqual([node.title for node in outline.root.children], ['a.text', 'b.text', 'c.text'])
+        self.assertEqual(outline.root.children[-1], outline.nodes[top])
+
+
+class StoreHtmlTest(unittest.TestCase): # the export replaces the former one when complete
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.jsetfp = ilunote.JSETFP
+        ilunote.JSETFP = os.path.join(self.folder, 'settings.json')
+        self.filename = os.path.join(self.folder, 'notes.html')
+        with open(self.filename, 'wb') as fh:
+            fh.write('former export')
+        self.persistence = ilunote.Persistence()
+
+    def tearDown(self):
+        ilunote.JSETFP = self.jsetfp
+        shutil.rmtree(self.folder)
+
+    def store(self, sections):
+        self.persistence.iter_html = lambda: iter(sections)
+        return self.persistence.store_html(ilunote.Outline(), self.filename)
+
+    def test_failed(self):
+        def sections():
+            yield '<h1>a</h1>'
+            raise ValueError('cut')
+        self.assertEqual(self.store(sections()), (False, None))
+        with open(self.filename, 'rb') as fh:
+            self.assertEqual(fh.read(), 'former export')
+        self.assertFalse(os.path.exists(self.filename + '.tmp'))
+
+    def test_stored(self):
+        self.assertEqual(self.store(['<h1>a</h1>', '<p>b</p>']), (True, self.filename))
+        with open(self.filename, 'rb') as fh:
+            self.assertTrue('<h1>a</h1>\n<p>b</p>' in fh.read())
+
+
+if __name__ == '__main__':
+    unittest.main()